@@ -0,0 +1,30 @@
+import gc
+import os
+
+# Import app.py (dataset, cube and figures) once in the master process. The forked workers
+# then share those pages copy-on-write instead of each holding its own copy of the data.
+# Set PRICEANALYZER_PRELOAD=0 to import the app separately in every worker again.
+# Lazy startup (PRICEANALYZER_LAZY=1) builds the state in a thread after the import, and
+# threads do not survive the fork, so each worker then imports the app itself.
+preload_app = (os.environ.get('PRICEANALYZER_PRELOAD', '1') == '1'
+               and os.environ.get('PRICEANALYZER_LAZY', '0') != '1')
+
+if preload_app:
+    # The master builds the state while preloading but never serves it, so it must not start
+    # the export watcher (a second full state on every reload, and a live thread at fork time)
+    os.environ['PRICEANALYZER_MASTER_PID'] = str(os.getpid())
+
+
+def post_fork(server, worker):
+    # Start the export watcher of a worker right away instead of on its first request
+    if preload_app:
+        import state
+        if state.WATCH:
+            state.ensure_watcher()
+
+
+def when_ready(server):
+    # Called in the master after preloading and before the workers are forked: move all
+    # objects into the permanent generation so garbage collection in the workers does not
+    # write to (and thereby copy) the shared pages
+    gc.freeze()
@@ -0,0 +1,31 @@
+import numpy as np
+
+# Bootstrap settings for the confidence interval of the median price. Resamples are drawn in
+# batches of at most BOOTSTRAP_BATCH_VALUES values (about 16 MB), and at least BOOTSTRAP_BATCHES
+# batches for a smooth progress bar.
+BOOTSTRAP_RESAMPLES = 5000
+BOOTSTRAP_CONFIDENCE = 0.95
+BOOTSTRAP_BATCHES = 10
+BOOTSTRAP_BATCH_VALUES = 2_000_000
+
+
+def bootstrap_median_ci(values, resamples=BOOTSTRAP_RESAMPLES, confidence=BOOTSTRAP_CONFIDENCE,
+                        progress=None, seed=0):
+    # Percentile bootstrap confidence interval of the median as (lower, upper), None with fewer
+    # than two values. progress(done, total) is called after each batch. The fixed seed makes
+    # repeated runs return the same interval.
+    values = np.asarray(values, dtype=np.float64)
+    if len(values) < 2:
+        return None
+    batch_size = max(1, min(resamples // BOOTSTRAP_BATCHES, BOOTSTRAP_BATCH_VALUES // len(values)))
+    batches = np.array_split(np.arange(resamples), -(-resamples // batch_size))
+    rng = np.random.default_rng(seed)
+    medians = []
+    for done, batch in enumerate(batches, 1):
+        samples = values[rng.integers(0, len(values), size=(len(batch), len(values)))]
+        medians.append(np.median(samples, axis=1))
+        if progress is not None:
+            progress(done, len(batches))
+    alpha = (1 - confidence) / 2
+    lower, upper = np.quantile(np.concatenate(medians), [alpha, 1 - alpha])
+    return float(lower), float(upper)
@@ -0,0 +1,212 @@
+import csv
+import io
+import os
+from datetime import datetime, timezone
+from functools import lru_cache
+
+import numpy as np
+from flask import Blueprint, Response, jsonify, request
+
+from compression import COMPRESS_LEVEL, encoded_etag
+from cube import TOTAL
+from filters import EXTRA_FILTERS, FILTER_DIMENSIONS
+from kpis import KPI_COLUMNS, KPI_TABLE_COLUMNS, tile_kpis
+from state import ready_state
+from windows import QOQ, YOY, quarter_label, window_quarters
+
+# Read-only access to the cube for scripts and spreadsheets, as plain Flask routes next to the
+# Dash app (no renderer, no callbacks). Responses carry the dataset version as ETag and the
+# export's modification time as Last-Modified; a client revalidating an unchanged dataset gets
+# a 304 without the cube being read at all.
+api = Blueprint('api', __name__, url_prefix='/api')
+
+# The CSV is sent in pieces of about this many characters
+CSV_CHUNK_SIZE = 64 * 1024
+
+# Most selections accepted by one /api/kpis request
+BATCH_MAX_SELECTIONS = int(os.environ.get('PRICEANALYZER_BATCH_MAX_SELECTIONS', '1000'))
+
+
+@lru_cache(maxsize=8)
+def last_modified(version, paths):
+    # Newest modification time of the files a state was built from, to the second (the
+    # resolution of HTTP dates). Cached per version, so it does not move if a file is touched
+    # while the state is served.
+    mtimes = []
+    for path in paths:
+        try:
+            mtimes.append(os.path.getmtime(path))
+        except OSError:
+            # e.g. the deltas of a bundle, which are recorded by name only
+            pass
+    return datetime.fromtimestamp(int(max(mtimes)), timezone.utc) if mtimes else None
+
+
+def representation_etags(etag):
+    # Compressed responses carry the ETag with the encoding appended, see compression.py
+    return [etag] + [encoded_etag(etag, encoding) for encoding in COMPRESS_LEVEL]
+
+
+def not_modified_etag(etag, modified):
+    # The ETag to answer with 304 if the client's copy is current, else None. If-None-Match
+    # takes precedence over If-Modified-Since.
+    if request.if_none_match:
+        return next((tag for tag in representation_etags(etag) if request.if_none_match.contains_weak(tag)), None)
+    if request.if_modified_since and modified and modified <= request.if_modified_since:
+        return etag
+    return None
+
+
+def cached_response(state, make_response):
+    # 304 if the client already has this version, otherwise the response make_response() builds
+    modified = last_modified(state.version, (state.source, *state.deltas))
+    etag = not_modified_etag(state.version, modified)
+    if etag is not None:
+        response = Response(status=304)
+    else:
+        etag = state.version
+        response = make_response()
+    response.set_etag(etag)
+    if modified:
+        response.last_modified = modified
+    # Clients may keep the response but have to revalidate it, since the data can be reloaded
+    response.cache_control.public = True
+    response.cache_control.no_cache = True
+    return response
+
+
+def cube_rows(state, args):
+    # Rows of the KPI table (see kpis.kpi_table) as lists in the order of KPI_TABLE_COLUMNS,
+    # optionally restricted by the query parameters Kategorie, fahrzeugalter_cat ('Total' for
+    # the roll-ups) and from/to (quarters like 2023Q1, both inclusive)
+    table = state.table
+    selected = np.ones(len(table), dtype=bool)
+    for column in ['Kategorie', 'fahrzeugalter_cat']:
+        if args.get(column) is not None:
+            selected &= (table[column] == args[column]).to_numpy()
+    if args.get('from') is not None:
+        selected &= (table['Quarter'] >= args['from']).to_numpy()
+    if args.get('to') is not None:
+        selected &= (table['Quarter'] <= args['to']).to_numpy()
+    for row in table[selected].itertuples(index=False, name=None):
+        yield [None if isinstance(value, float) and np.isnan(value) else value for value in row]
+
+
+def csv_chunks(rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(KPI_TABLE_COLUMNS)
+    for row in rows:
+        writer.writerow(row)
+        if buffer.tell() >= CSV_CHUNK_SIZE:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def parse_selections(body):
+    # The selections of a /api/kpis request as {column: value} over all FILTER_DIMENSIONS
+    # (dimensions not given are 'Total'), or an error message
+    selections = body.get('selections') if isinstance(body, dict) else None
+    if not isinstance(selections, list):
+        return None, 'expected a JSON object with a list "selections"'
+    if len(selections) > BATCH_MAX_SELECTIONS:
+        return None, f'at most {BATCH_MAX_SELECTIONS} selections per request'
+    parsed = []
+    for selection in selections:
+        if not isinstance(selection, dict) or not set(selection) <= set(FILTER_DIMENSIONS):
+            return None, f'selections are objects with the keys {", ".join(FILTER_DIMENSIONS)}'
+        if not all(isinstance(value, str) for value in selection.values()):
+            return None, 'selection values are strings'
+        parsed.append({column: selection.get(column, TOTAL) for column in FILTER_DIMENSIONS})
+    return parsed, None
+
+
+def selection_kpis(state, selections):
+    # KPI_COLUMNS of the selections. Plain segments are answered from the precomputed tile
+    # values, all selections with extra filters together in one pass over the rows.
+    result = {column: [None] * len(selections) for column in KPI_COLUMNS}
+    filtered = []
+    for position, selection in enumerate(selections):
+        if any(selection[column] != TOTAL for column in EXTRA_FILTERS):
+            filtered.append(position)
+            continue
+        segment = selection['Kategorie'], selection['fahrzeugalter_cat']
+        kpis = state.kpis.get(segment) or tile_kpis(state.cube, *segment, state.current_quarter, state.price_index)
+        for column in KPI_COLUMNS:
+            result[column][position] = kpis[column]
+    if filtered:
+        batch = state.planner.batch_kpis(state.current_quarter, [selections[position] for position in filtered])
+        for column in KPI_COLUMNS:
+            for position, value in zip(filtered, batch[column]):
+                result[column][position] = value
+    return result
+
+
+def error(message, status=400):
+    response = jsonify({'error': message})
+    response.status_code = status
+    return response
+
+
+def warming_up():
+    response = jsonify({'status': 'warming up'})
+    response.status_code = 503
+    response.headers['Retry-After'] = '5'
+    return response
+
+
+@api.route('/cube')
+def cube_json():
+    # {'version': ..., 'current_quarter': ..., 'columns': [...], 'rows': [[...], ...]}
+    state = ready_state()
+    if state is None:
+        return warming_up()
+    return cached_response(state, lambda: jsonify({
+        'version': state.version,
+        'current_quarter': state.current_quarter,
+        'columns': KPI_TABLE_COLUMNS,
+        'rows': list(cube_rows(state, request.args)),
+    }))
+
+
+@api.route('/cube.csv')
+def cube_csv():
+    # The same rows as CSV, streamed while they are written (after the request context is
+    # gone, hence the arguments are passed in)
+    state = ready_state()
+    if state is None:
+        return warming_up()
+    return cached_response(state, lambda: Response(csv_chunks(cube_rows(state, request.args)), mimetype='text/csv'))
+
+
+@api.route('/kpis', methods=['POST'])
+def kpis_batch():
+    # Tile values of many selections in one request. Body: {"selections": [{"Kategorie":
+    # "Kastenwagen", "region": "Süd"}, ...]}. Columnar response with one entry per selection in
+    # every list: the dimensions of the selection followed by KPI_COLUMNS.
+    state = ready_state()
+    if state is None:
+        return warming_up()
+    selections, message = parse_selections(request.get_json(silent=True))
+    if message:
+        return error(message)
+    available = state.planner.filters if state.planner is not None else []
+    unavailable = sorted({column for selection in selections for column in EXTRA_FILTERS
+                          if selection[column] != TOTAL and column not in available})
+    if unavailable:
+        # Bundle mode keeps only the cube, streaming mode the sketches of some dimensions
+        return error(f'filters on {", ".join(unavailable)} are not available, the price rows are not loaded')
+    return jsonify({
+        'version': state.version,
+        'labels': {
+            'current_quarter': quarter_label(state.current_quarter),
+            'previous_year_quarter': quarter_label(window_quarters(state.current_quarter, 1, YOY)[0]),
+            'previous_quarter': quarter_label(window_quarters(state.current_quarter, 1, QOQ)[0]),
+        },
+        'columns': {
+            **{column: [selection[column] for selection in selections] for column in FILTER_DIMENSIONS},
+            **selection_kpis(state, selections),
+        },
+    })
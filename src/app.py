@@ -1,9 +1,40 @@
+import copy
+import os
+from urllib.parse import parse_qsl, urlsplit
+
 import dash
-from dash import Dash, dcc, html, dash_table
-import pandas as pd
+from dash import Dash, DiskcacheManager, Patch, dcc, html, dash_table
 import plotly.graph_objs as go
-from dash.dependencies import Input, Output
-
+from dash.dependencies import ClientsideFunction, Input, Output, State
+from flask import request
+
+try:
+    import diskcache
+except ImportError:
+    diskcache = None
+
+from analytics import bootstrap_median_ci
+from api import api
+from cache import CACHE_TTL, ResultCache, cache_key
+from compression import ResponseCompressor
+from cube import TOTAL, lookup
+from figures import chart_quarters, figure_json, price_graph_data
+from filters import EXTRA_FILTERS, FILTER_DIMENSIONS
+from kpis import tile_kpis
+from query import filter_key
+from state import LAZY, current_state, empty_state, ready_state, start_warmup
+from windows import quarter_label
+
+# With PRICEANALYZER_CLIENTSIDE=1 the page ships the precomputed values of all dropdown
+# combinations in a dcc.Store, and tiles, price graph and data alert are updated in the browser
+# (assets/clientside.js) without a request per click. The extra filters need the server and
+# are disabled in this mode.
+CLIENTSIDE = os.environ.get('PRICEANALYZER_CLIENTSIDE', '0') == '1'
+
+# Heavier analyses (the bootstrap confidence interval) run as background callbacks when diskcache
+# is installed: in a separate process, with a progress bar, and with results cached per dataset
+# version in PRICEANALYZER_BACKGROUND_DIR. Without it they run as normal callbacks.
+BACKGROUND_DIR = os.environ.get('PRICEANALYZER_BACKGROUND_DIR', '.background')
 
 
 
@@ -42,6 +73,34 @@ header_style = {
     'margin-bottom': '10px'  # Adjust the value as needed for desired spacing
 }
 
+# Style for the numbers in the tiles
+number_style = {
+    'font-size': '20px',  # Increase font size as needed
+    'font-weight': 'bold'  # Optional: make the font bold
+}
+
+# Hint about too few sales
+alert_text = 'Hinweis: Für das letzte Quartal liegen uns zu wenige Daten vor. Bitte wählen Sie weniger Parameter.'
+alert_style = {
+    'color': 'red',
+    'fontWeight': 'bold',
+    'fontSize': '17px',
+    'display': 'left',
+    'alignItems': 'left',
+    'justifyContent': 'left',
+    'height': '100%'
+}
+
+# Headings of the extra filter dropdowns
+filter_labels = {
+    'Kilometer_cat': 'Kilometerstand',
+    'region': 'Region',
+    'Bundesland': 'Bundesland',
+    'Getriebeart': 'Getriebeart',
+    'Chassis': 'Chassis',
+    'Marke': 'Marke',
+}
+
 def get_color(value):
     if value is None:
         return "#000000"  # Default to black if data is not available
@@ -52,412 +111,271 @@ def format_number(value):
         return 'N/A'
     return f"{value:,}".replace(",", ".")
 
-
-# Load data
-df = pd.read_csv('pricedata8.csv')
-
-df = df[~df['Kategorie'].isin(['Bus', 'Wohnwagen'])]
-
-# Data preprocessing
-data = df
-data['Verkauf in'] = pd.to_datetime(data['Verkauf in'])
-data['Quarter'] = data['Verkauf in'].dt.to_period('Q')
-
-
-
-
-colors = ['#F97A1F', '#C91D42', '#1DC9A4', '#141F52', '#B3B3B3' ]
-
-# Define a consistent category order
-category_order = sorted(data['Kategorie'].apply(str).unique())
-
-# Processing for Line Chart
-category_grouped = data.groupby(['Kategorie', 'Quarter']).agg({'Verkaufspreis': 'median'}).reset_index()
-category_grouped.sort_values('Quarter', inplace=True)
-last_five_quarters = category_grouped['Quarter'].unique()[-5:]
-category_grouped = category_grouped[category_grouped['Quarter'].isin(last_five_quarters)]
-
-# Creating Line Chart
-category_line_chart_figure = go.Figure()
-
-for i, category in enumerate(category_order):
-    category_data = category_grouped[category_grouped['Kategorie'] == category]
-    category_line_chart_figure.add_trace(go.Scatter(
-        x=category_data['Quarter'].astype(str),
-        y=category_data['Verkaufspreis'],
-        mode='lines+markers',
-        name=category,
-        line=dict(color=colors[i % len(colors)])
-    ))
-
-
-
-y_values = list(range(0, 100001, 10000))  # Convert range to list
-ticktext = [str(int(value / 1000)) for value in y_values]  # Convert to simpler numbers
-
-category_line_chart_figure.update_layout(
-    xaxis_title='Quartal',
-    yaxis_title='Medianpreis (in Tsd)',
-    legend=dict(
-        orientation='h',
-        x=0.5,
-        y=-0.3,
-        xanchor='center',
-        yanchor='top'
-    ),
-    margin=dict(l=20, r=20, t=20, b=20),
-    font=dict(family='Roboto Condensed', size=14),
-    yaxis=dict(
-        tickvals=y_values,
-        ticktext=ticktext
-    )
-)
-
-data['Verkauf in'] = pd.to_datetime(data['Verkauf in'])
-data['Quarter'] = pd.PeriodIndex(data['Verkauf in'].dt.to_period('Q'), freq='Q')
-last_five_quarters = data['Quarter'].drop_duplicates().sort_values()[-5:]
-data_last_five_quarters = data[data['Quarter'].isin(last_five_quarters)]
-
-# Adjusting to count the number of sales per category per quarter instead of summing sales price
-quarterly_sales_count = data_last_five_quarters.groupby(['Quarter', 'Kategorie']).size().reset_index(name='Anzahl Verkäufe')
-quarterly_totals_count = quarterly_sales_count.groupby('Quarter')['Anzahl Verkäufe'].sum().reset_index()
-
-# Merging the count data with total counts for each quarter to calculate percentages
-merged_data_count = pd.merge(quarterly_sales_count, quarterly_totals_count, on='Quarter', suffixes=('', '_total'))
-merged_data_count['Percentage'] = (merged_data_count['Anzahl Verkäufe'] / merged_data_count['Anzahl Verkäufe_total']) * 100
-
-# Creating Stacked Bar Chart based on sales count
-stacked_bar_chart_figure = go.Figure()
-
-for i, category in enumerate(category_order):
-    category_data = merged_data_count[merged_data_count['Kategorie'] == category]
-    stacked_bar_chart_figure.add_trace(go.Bar(
-        name=category,
-        x=category_data['Quarter'].astype(str),
-        y=category_data['Percentage'],
-        text=category_data['Percentage'].apply(lambda x: f'{x:.0f}%'),
-        textposition='inside',
-        marker_color=colors[i % len(colors)]
-    ))
-
-stacked_bar_chart_figure.update_layout(
-    barmode='stack',
-    xaxis=dict(
-        title='Quartal',
-        type='category'
-    ),
-    yaxis=dict(
-        title='Prozentualer Anteil (%)',
-        tickformat=',d'
-    ),
-    legend=dict(
-        orientation='h',
-        x=0.5,
-        y=-0.3,
-        xanchor='center',
-        yanchor='top'
-    ),
-    legend_title_text='Fahrzeugkategorie',
-    margin=dict(l=20, r=20, t=20, b=20),
-    font=dict(family='Roboto Condensed', size=14) # Set font for the entire layout
-)
-
-
-# Group by vehicle age category and quarter
-age_cat_grouped = data.groupby(['fahrzeugalter_cat', 'Quarter']).agg({'Verkaufspreis': 'median'}).reset_index()
-age_cat_grouped.sort_values('Quarter', inplace=True)
-last_five_quarters = age_cat_grouped['Quarter'].unique()[-5:]
-age_cat_grouped = age_cat_grouped[age_cat_grouped['Quarter'].isin(last_five_quarters)]
-
-# Create line chart for vehicle age categories
-vehicle_age_line_chart_figure = go.Figure()
-#age_order = sorted(data['fahrzeugalter_cat'].unique())
-age_order = ["Bis 2 Jahre", "2 - 4 Jahre", "4 - 6 Jahre", "6 - 10 Jahre", "Über 10 Jahre"]
-
-for i, age_cat in enumerate(age_order):
-    age_data = age_cat_grouped[age_cat_grouped['fahrzeugalter_cat'] == age_cat]
-    vehicle_age_line_chart_figure.add_trace(go.Scatter(
-        x=age_data['Quarter'].astype(str),
-        y=age_data['Verkaufspreis'],
-        mode='lines+markers',
-        name=age_cat,
-        line=dict(color=colors[i % len(colors)])
-    ))
-
-y_values = list(range(0, 100001, 10000))  # Convert range to list
-ticktext = [str(int(value / 1000)) for value in y_values]  # Convert to simpler numbers
-
-vehicle_age_line_chart_figure.update_layout(
-    xaxis_title='Quartal',
-    yaxis_title='Medianpreis (in Tsd)',
-    legend=dict(
-        orientation='h',
-        x=0.5,
-        y=-0.3,
-        xanchor='center',
-        yanchor='top'
-    ),
-    margin=dict(l=20, r=20, t=20, b=70),
-    font=dict(family='Roboto Condensed', size=14)
-    # Removed manual yaxis tickvals and ticktext to allow automatic scaling
-)
-
-
-
-
-
-# Filter the data for the last five quarters
-# Data preprocessing for vehicle age categories
-data['Verkauf in'] = pd.to_datetime(data['Verkauf in'])
-data['Quarter'] = pd.PeriodIndex(data['Verkauf in'].dt.to_period('Q'), freq='Q')
-last_five_quarters = data['Quarter'].drop_duplicates().sort_values()[-5:]
-data_last_five_quarters = data[data['Quarter'].isin(last_five_quarters)]
-
-# Adjusting to count the number of sales per vehicle age category per quarter
-age_cat_sales_count = data_last_five_quarters.groupby(['Quarter', 'fahrzeugalter_cat']).size().reset_index(name='Anzahl Verkäufe')
-quarterly_totals_count = age_cat_sales_count.groupby('Quarter')['Anzahl Verkäufe'].sum().reset_index()
-
-# Merging the count data with total counts for each quarter to calculate percentages
-merged_data_age_count = pd.merge(age_cat_sales_count, quarterly_totals_count, on='Quarter', suffixes=('', '_total'))
-merged_data_age_count['Percentage'] = (merged_data_age_count['Anzahl Verkäufe'] / merged_data_age_count['Anzahl Verkäufe_total']) * 100
-
-# Creating Stacked Bar Chart based on sales count for vehicle age categories
-vehicle_age_stacked_bar_figure = go.Figure()
-
-
-for i, age_cat in enumerate(age_order):
-    age_cat_data = merged_data_age_count[merged_data_age_count['fahrzeugalter_cat'] == age_cat]
-    vehicle_age_stacked_bar_figure.add_trace(go.Bar(
-        name=age_cat,
-        x=age_cat_data['Quarter'].astype(str),
-        y=age_cat_data['Percentage'],
-        text=age_cat_data['Percentage'].apply(lambda x: f'{x:.0f}%'),
-        textposition='inside',
-        marker_color=colors[i % len(colors)]
-    ))
-
-# Update layout for the stacked bar chart to reflect counts-based percentages
-vehicle_age_stacked_bar_figure.update_layout(
-    barmode='stack',
-    xaxis=dict(
-        title='Quartal',
-        type='category'
-    ),
-    yaxis=dict(
-        title='Prozentualer Anteil (%)',
-        tickformat=',d'
-    ),
-    legend=dict(
-        orientation='h',
-        x=0.5,
-        y=-0.3,
-        xanchor='center',
-        yanchor='top',
-        title='Fahrzeugalter Kategorie'
-    ),
-    margin=dict(l=20, r=20, t=20, b=20),
-    font=dict(family='Roboto Condensed', size=14)
-)
-
-
-
-
-
+def available_filters(state):
+    # Extra filters that can be selected; the clientside mode only knows the precomputed segments
+    if state.planner is None or CLIENTSIDE:
+        return []
+    return state.planner.filters
+
+def filter_dropdown(state, column, value):
+    # Extra filters are disabled when the planner of the state cannot apply them (bundle mode has none,
+    # streaming mode only some), and so are columns the export does not have
+    return html.Div([
+        html.H3(filter_labels[column], style={'textAlign': 'center'}),
+        dcc.Dropdown(
+            id=f'{column}-dropdown',
+            options=[{'label': k, 'value': k} for k in state.options.get(column, [])] + [{'label': 'Total', 'value': 'Total'}],
+            value=value,
+            disabled=column not in available_filters(state) or not state.options.get(column),
+            style={'width': '100%', 'margin-right': '10px'}
+        )
+    ], style={'width': '33%', 'display': 'inline-block', 'padding': '10px'})
+
+def query_segment(state, selected_category, selected_age_cat, extra_filters):
+    # Cube and price index to answer a selection from (see query.QueryPlanner)
+    if state.planner is None:
+        return state.cube, state.price_index
+    _, cube, price_index = state.planner.query(selected_category, selected_age_cat, extra_filters)
+    return cube, price_index
+
+def segment_kpis(state, cube, price_index, selected_category, selected_age_cat):
+    # Tile values are precomputed per dropdown combination
+    if cube is state.cube and (selected_category, selected_age_cat) in state.kpis:
+        return state.kpis[(selected_category, selected_age_cat)]
+    return tile_kpis(cube, selected_category, selected_age_cat, state.current_quarter, price_index)
 
 
+# Creating the Dash app
+app = Dash(__name__)
+server = app.server
 
+if LAZY:
+    # Bind right away and build the state in the background; a page load that comes
+    # earlier waits for the warm-up to finish
+    start_warmup()
+else:
+    # Build the initial state at import time, so with gunicorn's preload it is shared by all workers
+    current_state()
 
 
+# Rendered callback outputs, keyed by the inputs and the dataset version
+result_cache = ResultCache()
 
+# gzip/brotli for layout, callback responses and the JS bundles
+compressor = ResponseCompressor()
+compressor.init_app(server)
 
+# JSON/CSV access to the cube under /api (see api.py)
+server.register_blueprint(api)
 
 
+@server.route('/metrics')
+def metrics():
+    # Counters of this worker process
+    state = ready_state()
+    return {
+        'version': state.version if state is not None else None,
+        'pid': os.getpid(),
+        'result_cache': result_cache.stats(),
+        'compression': compressor.metrics(),
+    }
 
-# Creating the Dash app
-app = Dash(__name__)
-server = app.server
 
-app.layout = html.Div([
-    html.Link(
-        rel='stylesheet',
-        href='https://fonts.googleapis.com/css2?family=Roboto+Condensed:wght@400;700&display=swap'
-    ),
-    html.Div([
-        html.Img(src='assets/Header_PriceAnalyzer.jpg'),
-        html.A(html.Img(src='assets/Feedback_PriceAnalyzer.jpg'), href='http://www.miios.de', target='_blank'),
+@server.route('/ready')
+def ready():
+    # Readiness probe: 200 once data, cube and figures are built, 503 while warming up
+    state = ready_state()
+    if state is None:
+        return {'status': 'warming up'}, 503
+    return {'status': 'ready', 'version': state.version}
+
+
+def requested_selection(state):
+    # Selection deep-linked in the page URL (?Kategorie=Kastenwagen&region=Süd), 'Total' for
+    # dimensions not given or with unknown values. The layout is fetched by a script on the page,
+    # so the page URL arrives as the referrer.
+    args = dict(request.args)
+    if not args and request.referrer:
+        args = dict(parse_qsl(urlsplit(request.referrer).query))
+    columns = FILTER_DIMENSIONS[:2] + list(available_filters(state))
+    return {column: args[column] if args.get(column) in state.options.get(column, []) else TOTAL
+            for column in columns}
+
+
+def build_layout(state, selection=None):
+    chart_start = chart_quarters(state.current_quarter)[:1]
+    selection = selection or {}
+    values = {column: selection.get(column, TOTAL) for column in FILTER_DIMENSIONS}
+    # Render the selection into the layout, so the page shows it without waiting for the callback
+    if state.current_quarter is not None:
+        *tiles, graph, alert = cached_selection(state, values['Kategorie'], values['fahrzeugalter_cat'],
+                                                tuple(values[column] for column in EXTRA_FILTERS))
+        figure = graph_figure(graph)
+    else:
+        tiles, figure, alert = ['Tile 1', 'Tile 2', 'Tile 3', 'Tile 4'], price_graph_figure, None
+    return html.Div([
+        html.Link(
+            rel='stylesheet',
+            href='https://fonts.googleapis.com/css2?family=Roboto+Condensed:wght@400;700&display=swap'
+        ),
+        *([dcc.Store(id='segment-store', data=client_store(state))] if CLIENTSIDE else []),
+        dcc.Location(id='url', refresh=False),
         html.Div([
+            html.Img(src='assets/Header_PriceAnalyzer.jpg'),
+            html.A(html.Img(src='assets/Feedback_PriceAnalyzer.jpg'), href='http://www.miios.de', target='_blank'),
             html.Div([
-                html.H2("Kerndaten auf einem Blick:", style={'textAlign': 'left', 'margin-top': '20px'})
-            ], style={'width': '70%', 'display': 'inline-block'}),
+                html.Div([
+                    html.H2("Kerndaten auf einem Blick:", style={'textAlign': 'left', 'margin-top': '20px'})
+                ], style={'width': '70%', 'display': 'inline-block'}),
         
-        ], style={'display': 'flex', 'width': '100%'}),
-        html.Div([
-            html.Div('Tile 1', id='tile-1', style=tile_style),
-            html.Div('Tile 2', id='tile-2', style=tile_style),
-            html.Div('Tile 3', id='tile-3', style=tile_style),
-            html.Div('Tile 4', id='tile-4', style=tile_style)
-        ], style={'display': 'flex', 'justify-content': 'space-around', 'width': '100%'}),
-        html.Div([
+            ], style={'display': 'flex', 'width': '100%'}),
             html.Div([
-                html.H3('Fahrzeugtyp', style={'textAlign': 'center'}),
-                dcc.Dropdown(
-                    id='category-dropdown',
-                    options=[{'label': k, 'value': k} for k in data['Kategorie'].dropna().unique()] + [{'label': 'Total', 'value': 'Total'}],
-                    value='Total',
-                    style={'width': '100%', 'margin-right': '10px'}
-                )
-            ], style={'width': '50%', 'display': 'inline-block', 'padding': '10px'}),
+                html.Div(tiles[0], id='tile-1', style=tile_style),
+                html.Div(tiles[1], id='tile-2', style=tile_style),
+                html.Div(tiles[2], id='tile-3', style=tile_style),
+                html.Div(tiles[3], id='tile-4', style=tile_style)
+            ], style={'display': 'flex', 'justify-content': 'space-around', 'width': '100%'}),
             html.Div([
-                html.H3('Alter des Fahrzeugs', style={'textAlign': 'center'}),
-                dcc.Dropdown(
-                    id='age-cat-dropdown',
-                    options=[{'label': k, 'value': k} for k in data['fahrzeugalter_cat'].unique()] + [{'label': 'Total', 'value': 'Total'}],
-                    value='Total',
-                    style={'width': '100%', 'margin-right': '10px'}
-                )
-            ], style={'width': '50%', 'display': 'inline-block', 'padding': '10px'})
-        ], style={'display': 'flex', 'width': '100%'}),
-        html.Div([
+                html.Div([
+                    html.H3('Fahrzeugtyp', style={'textAlign': 'center'}),
+                    dcc.Dropdown(
+                        id='category-dropdown',
+                        options=[{'label': k, 'value': k} for k in state.options['Kategorie']] + [{'label': 'Total', 'value': 'Total'}],
+                        value=values['Kategorie'],
+                        style={'width': '100%', 'margin-right': '10px'}
+                    )
+                ], style={'width': '50%', 'display': 'inline-block', 'padding': '10px'}),
+                html.Div([
+                    html.H3('Alter des Fahrzeugs', style={'textAlign': 'center'}),
+                    dcc.Dropdown(
+                        id='age-cat-dropdown',
+                        options=[{'label': k, 'value': k} for k in state.options['fahrzeugalter_cat']] + [{'label': 'Total', 'value': 'Total'}],
+                        value=values['fahrzeugalter_cat'],
+                        style={'width': '100%', 'margin-right': '10px'}
+                    )
+                ], style={'width': '50%', 'display': 'inline-block', 'padding': '10px'})
+            ], style={'display': 'flex', 'width': '100%'}),
+            html.Div([filter_dropdown(state, column, values[column]) for column in EXTRA_FILTERS[:3]], style={'display': 'flex', 'width': '100%'}),
+            html.Div([filter_dropdown(state, column, values[column]) for column in EXTRA_FILTERS[3:]], style={'display': 'flex', 'width': '100%'}),
             html.Div([
-                html.H2("Preisentwicklung seit Q4/2022", style={'textAlign': 'center'}),
-                dcc.Graph(id='price-graph'),
+                html.Div([
+                    html.H2(f"Preisentwicklung seit {quarter_label(chart_start[0])}" if chart_start else "Preisentwicklung", style={'textAlign': 'center'}),
+                    dcc.Graph(id='price-graph', figure=figure),
                 
-            ], style={'width': '60%', 'display': 'inline-block'}),
-            html.Div([
+                ], style={'width': '60%', 'display': 'inline-block'}),
                 html.Div([
                     html.Div([
-                        html.Img(src='assets/OlegRubinov_Kommentar.jpg', style={'width': '100%', 'border-radius': '50%'})  # Ensure this path is correct
-                    ], style={'width': '25%', 'display': 'inline-block', 'padding': '5px'}),
-                    html.Div([
-                        html.H4("Oleg Rubinov", style={'margin': '0', 'color': '#b22122', 'fontSize': '24px', }),  # Name with larger font size and red color
-                html.P("Co-Gründer & Geschäftsführer caravanmarkt24.de", style={'color': 'black', 'margin': '0'})  # Subtitle in normal size and black color
-                    ], style={'width': '75%', 'display': 'inline-block', 'padding': '5px'})
-                ], style={'display': 'flex', 'alignItems': 'center'}),
-                html.P("""Der Markt für gebrauchte Freizeitfahrzeuge bietet Chancen für den Handel, mit stabiler Nachfrage und moderaten Preissenkungen in bestimmten Segmenten und Altersklassen. Besonders gefragt sind gut gepflegte Reisemobile und Caravans der Altersklasse 2-4 Jahre. Fachhändler können durch den Zukauf junger Gebrauchter Erträge sichern und neue Kundensegmente erschließen. caravanmarkt24 rät zum Mut beim Gebrauchtwagenhandel!
-""",
-                style={
-                    'backgroundColor': '#f0f0f0',
-                    'borderRadius': '10px',
-                    'padding': '30px',
-                    'fontSize': '18px',
-                    'lineHeight': '1.5'
-                })
-            ], style={'width': '40%', 'display': 'inline-block', 'verticalAlign': 'top', 'margin': '10px'})
-        ], style={'display': 'flex', 'width': '100%'}),
-
-        html.Div(id='data-alert', style={'textAlign': 'left', 'marginTop': 20, 'marginBottom': 20, }),
-
-
-         html.Div(style={'height': '20px'}),
-    html.Img(src='assets/Fahrzeugkategorie_Block.jpg'),
-
-    html.Div([
-        # Column for the line chart
-        html.Div([
-            dcc.Graph(
-                id='category_line_chart',
-                figure=category_line_chart_figure
-            ),
-        ], style={'width': '50%', 'display': 'inline-block'}),
-
-        # Column for the stacked bar chart
-        html.Div([
-            dcc.Graph(
-                id='stacked_bar_chart',
-                figure=stacked_bar_chart_figure
-            ),
-        ], style={'width': '50%', 'display': 'inline-block'}),
-    ], style={'display': 'flex', 'width': '100%', 'margin-top': '20px'}),
+                        html.Div([
+                            html.Img(src='assets/OlegRubinov_Kommentar.jpg', style={'width': '100%', 'border-radius': '50%'})  # Ensure this path is correct
+                        ], style={'width': '25%', 'display': 'inline-block', 'padding': '5px'}),
+                        html.Div([
+                            html.H4("Oleg Rubinov", style={'margin': '0', 'color': '#b22122', 'fontSize': '24px', }),  # Name with larger font size and red color
+                    html.P("Co-Gründer & Geschäftsführer caravanmarkt24.de", style={'color': 'black', 'margin': '0'})  # Subtitle in normal size and black color
+                        ], style={'width': '75%', 'display': 'inline-block', 'padding': '5px'})
+                    ], style={'display': 'flex', 'alignItems': 'center'}),
+                    html.P("""Der Markt für gebrauchte Freizeitfahrzeuge bietet Chancen für den Handel, mit stabiler Nachfrage und moderaten Preissenkungen in bestimmten Segmenten und Altersklassen. Besonders gefragt sind gut gepflegte Reisemobile und Caravans der Altersklasse 2-4 Jahre. Fachhändler können durch den Zukauf junger Gebrauchter Erträge sichern und neue Kundensegmente erschließen. caravanmarkt24 rät zum Mut beim Gebrauchtwagenhandel!
+    """,
+                    style={
+                        'backgroundColor': '#f0f0f0',
+                        'borderRadius': '10px',
+                        'padding': '30px',
+                        'fontSize': '18px',
+                        'lineHeight': '1.5'
+                    })
+                ], style={'width': '40%', 'display': 'inline-block', 'verticalAlign': 'top', 'margin': '10px'})
+            ], style={'display': 'flex', 'width': '100%'}),
+
+            html.Div(alert, id='data-alert', style={'textAlign': 'left', 'marginTop': 20, 'marginBottom': 20, }),
 
+            html.Div([
+                # Needs the individual prices, which streaming and bundle mode do not keep
+                html.Button('Konfidenzintervall berechnen', id='ci-button', n_clicks=0,
+                            disabled=state.price_index is None),
+                html.Progress(id='ci-progress', value='0', max='1', style={'margin-left': '10px'}),
+                html.Div(id='ci-result', style={'marginTop': 10}),
+            ], style={'marginBottom': 20}),
 
-       html.Div(style={'height': '20px'}),
-    html.Img(src='assets/Fahrzeugalter_Block.jpg'),
 
-    html.Div([
-        # Column for the line chart
-        html.Div([
-            dcc.Graph(
-                id='vehicle_age_line_chart',
-                figure=vehicle_age_line_chart_figure
-            ),
-        ], style={'width': '50%', 'display': 'inline-block'}),
+             html.Div(style={'height': '20px'}),
+        html.Img(src='assets/Fahrzeugkategorie_Block.jpg'),
 
-        # Column for the stacked bar chart
         html.Div([
-            dcc.Graph(
-                id='vehicle_age_stacked_bar',
-                figure=vehicle_age_stacked_bar_figure
-            ),
-        ], style={'width': '50%', 'display': 'inline-block'}),
-    ], style={'display': 'flex', 'width': '100%', 'margin-top': '20px'}),
-
-    ], style={'fontFamily': 'Roboto Condensed', 'maxWidth': '1000px', 'margin': '0 auto'})
-])
-
-# New callback to update the tiles based on dropdown selections
-@app.callback(
-    [Output('tile-1', 'children'),
-     Output('tile-2', 'children'),
-     Output('tile-3', 'children'),
-     Output('tile-4', 'children')],
-    [Input('category-dropdown', 'value'),
-     Input('age-cat-dropdown', 'value'), ]
-)
-def update_tiles(selected_category, selected_age_cat):
-    # Filter data based on dropdown values
-    filtered_data = data.copy()
-    if selected_category != 'Total':
-        filtered_data = filtered_data[filtered_data['Kategorie'] == selected_category]
-    if selected_age_cat != 'Total':
-        filtered_data = filtered_data[filtered_data['fahrzeugalter_cat'] == selected_age_cat]
-
-
-
-    # Calculate Median-Verkaufspreis for Q4 2023
-    q4_2023_data = filtered_data[filtered_data['Quarter'] == '2023Q4']
-    median_price_2023 = round(q4_2023_data['Verkaufspreis'].median())
-
-    # Calculate percentage difference vs. Q4 2022
-    q4_2022_data = filtered_data[filtered_data['Quarter'] == '2022Q4']
-    median_price_2022 = q4_2022_data['Verkaufspreis'].median()
-    percentage_diff_2022 = ((median_price_2023 - median_price_2022) / median_price_2022) * 100 if median_price_2022 else None
+            # Column for the line chart
+            html.Div([
+                dcc.Graph(
+                    id='category_line_chart',
+                    figure=state.figures['category_line_chart']
+                ),
+            ], style={'width': '50%', 'display': 'inline-block'}),
 
-    # Calculate percentage difference vs. previous quarter
-    current_quarter_period = pd.Period('2023Q4', freq='Q')  # Ändern Sie dies entsprechend, um das aktuelle Quartal dynamisch zu bestimmen
-    previous_quarter_period = current_quarter_period - 1
-    previous_quarter = previous_quarter_period.strftime('Q%q/%Y')
-    
-    previous_q_data = filtered_data[filtered_data['Quarter'] == previous_quarter_period]
-    median_price_previous = previous_q_data['Verkaufspreis'].median()
-    percentage_diff_previous = ((median_price_2023 - median_price_previous) / median_price_previous) * 100 if median_price_previous else None
+            # Column for the stacked bar chart
+            html.Div([
+                dcc.Graph(
+                    id='stacked_bar_chart',
+                    figure=state.figures['stacked_bar_chart']
+                ),
+            ], style={'width': '50%', 'display': 'inline-block'}),
+        ], style={'display': 'flex', 'width': '100%', 'margin-top': '20px'}),
 
 
+           html.Div(style={'height': '20px'}),
+        html.Img(src='assets/Fahrzeugalter_Block.jpg'),
 
-    # Calculate percentage difference between Verkaufspreis and Wunschpreis for the latest quarter
-    median_wunschpreis_2023 = q4_2023_data['Wunschpreis'].median()
-    percentage_diff_wunschpreis = ((median_price_2023 - median_wunschpreis_2023) / median_wunschpreis_2023) * 100 if median_wunschpreis_2023 else None
+        html.Div([
+            # Column for the line chart
+            html.Div([
+                dcc.Graph(
+                    id='vehicle_age_line_chart',
+                    figure=state.figures['vehicle_age_line_chart']
+                ),
+            ], style={'width': '50%', 'display': 'inline-block'}),
 
-    number_style = {
-        'font-size': '20px',  # Increase font size as needed
-        'font-weight': 'bold'  # Optional: make the font bold
-    }
+            # Column for the stacked bar chart
+            html.Div([
+                dcc.Graph(
+                    id='vehicle_age_stacked_bar',
+                    figure=state.figures['vehicle_age_stacked_bar']
+                ),
+            ], style={'width': '50%', 'display': 'inline-block'}),
+        ], style={'display': 'flex', 'width': '100%', 'margin-top': '20px'}),
+
+        ], style={'fontFamily': 'Roboto Condensed', 'maxWidth': '1000px', 'margin': '0 auto'})
+    ])
+
+
+def serve_layout():
+    # Built on every page load, so a reloaded export shows up without restarting the server.
+    # Dash also calls this once on the very first request to validate it; if that request
+    # is the readiness probe or an API call, don't make it wait for the warm-up.
+    if ready_state() is None and (request.endpoint == 'ready' or request.blueprint == 'api'):
+        return app.validation_layout
+    state = current_state()
+    return build_layout(state, requested_selection(state))
+
+
+# Tiles based on the dropdown selections
+def update_tiles(kpis):
+    median_price = kpis['median_price']
+    percentage_diff_previous_year = kpis['diff_previous_year']
+    percentage_diff_previous = kpis['diff_previous_quarter']
+    percentage_diff_wunschpreis = kpis['diff_wunschpreis']
 
     # Formatting tile contents
     tile_1_content = html.Div([
         html.Div(html.Strong("Händlereinkaufspreis"), style={'margin-bottom': '5px'}),
-        html.Div("(Q4/2023):", style={'margin-bottom': '10px'}),
-        html.Div(format_number(median_price_2023) + " €" if median_price_2023 else 'Data not available', style=number_style)
+        html.Div(f"({kpis['current_quarter']}):", style={'margin-bottom': '10px'}),
+        html.Div(format_number(median_price) + " €" if median_price else 'Data not available', style=number_style)
     ], style=tile_style)
 
     tile_2_content = html.Div([
         html.Div(html.Strong("Trend (Vorjahr)"), style={'margin-bottom': '5px'}),
-        html.Div("(vs. Q4/2022):", style={'margin-bottom': '10px'}),
-        html.Div(html.Span(f"{percentage_diff_2022:.2f}%", style={'color': get_color(percentage_diff_2022)}) if percentage_diff_2022 is not None else 'Data not available', style=number_style)
+        html.Div(f"(vs. {kpis['previous_year_quarter']}):", style={'margin-bottom': '10px'}),
+        html.Div(html.Span(f"{percentage_diff_previous_year:.2f}%", style={'color': get_color(percentage_diff_previous_year)}) if percentage_diff_previous_year is not None else 'Data not available', style=number_style)
     ], style=tile_style)
 
     tile_3_content = html.Div([
         html.Div(html.Strong("Trend (letztes Quartal)"), style={'margin-bottom': '5px'}),
-        html.Div(f"(vs. {previous_quarter}):", style={'margin-bottom': '10px'}),
+        html.Div(f"(vs. {kpis['previous_quarter']}):", style={'margin-bottom': '10px'}),
         html.Div(html.Span(f"{percentage_diff_previous:.2f}%", style={'color': get_color(percentage_diff_previous)}) if percentage_diff_previous is not None else 'Data not available', style=number_style)
     ], style=tile_style)
 
@@ -471,46 +389,30 @@ def update_tiles(selected_category, selected_age_cat):
 
 
 
-@app.callback(
-    [Output('price-graph', 'figure')],
-    [Input('category-dropdown', 'value'),
-     Input('age-cat-dropdown', 'value'),]
-)
-
-
-
-def update_graph(selected_category, selected_age_cat):
-    # Filter data based on dropdown values
-    filtered_data = data.copy()
-    if selected_category != 'Total':
-        filtered_data = filtered_data[filtered_data['Kategorie'] == selected_category]
-    if selected_age_cat != 'Total':
-        filtered_data = filtered_data[filtered_data['fahrzeugalter_cat'] == selected_age_cat]
-
-    # Group by quarter after filtering
-    filtered_quarterly = filtered_data.groupby('Quarter').agg({'Verkaufspreis': 'median'}).reset_index()
-
-    # Identify the last 5 quarters in the dataset
-    last_5_quarters = filtered_quarterly['Quarter'].unique()[-5:]
-
-    # Filter data to only include these quarters
-    filtered_quarterly = filtered_quarterly[filtered_quarterly['Quarter'].isin(last_5_quarters)]
+# Traces of the price graph: the edges of the percentile bands, where each upper edge fills
+# down to the trace before it, and the median line on top
+band_traces = ['P10', 'P90', 'P25', 'P75']
+band_fills = {'P90': ('P10–P90', 'rgba(178, 33, 34, 0.15)'), 'P75': ('P25–P75', 'rgba(178, 33, 34, 0.3)')}
 
-    # Adjust values to thousands for the graph
-    filtered_quarterly['Verkaufspreis'] = filtered_quarterly['Verkaufspreis'] / 1000
 
+def price_graph_skeleton():
+    # The price graph without data. It is built once and sent with the layout; the callback
+    # only patches the traces and the y-axis range.
     fig = go.Figure()
-    fig.add_trace(go.Scatter(x=filtered_quarterly['Quarter'].astype(str), y=filtered_quarterly['Verkaufspreis'],
+    for name in band_traces:
+        fill_name, fill_color = band_fills.get(name, (None, None))
+        fig.add_trace(go.Scatter(x=[], y=[],
+                                 mode='lines', line=dict(width=0), name=fill_name or name,
+                                 fill='tonexty' if fill_name else None, fillcolor=fill_color,
+                                 showlegend=fill_name is not None,
+                                 hovertemplate=f'{name}: %{{y:.1f}}<extra></extra>'))
+    fig.add_trace(go.Scatter(x=[], y=[],
                              mode='lines+markers', line=dict(color='#b22122', width=4), name='Medianpreis'))
 
-    # Dynamically adjust y-axis range
-    min_price = filtered_quarterly['Verkaufspreis'].min() - 10  # Subtract 10 units from the min value
-    max_price = filtered_quarterly['Verkaufspreis'].max() + 10  # Add 10 units to the max value
-
     fig.update_layout(
         yaxis=dict(
             title='Medianpreis (in Tsd. €)',
-            range=[min_price, max_price]  # Set the range from min to max with the adjustments
+            range=[None, None]  # Set by the callback from the prices shown
         ),
         xaxis_title='Quartal',
         margin=dict(l=20, r=20, t=10, b=20),
@@ -519,46 +421,242 @@ def update_graph(selected_category, selected_age_cat):
             y=0.99,
             bordercolor="Black",
             borderwidth=2,
-            orientation="h"
+            orientation="h",
+            traceorder='reversed'  # Median first
         ),
         font=dict(family='Roboto Condensed', size=14)  # Set the font globally for the figure
     )
 
-    # Only return the figure
-    return (fig,)
+    return fig
+
+
+price_graph_figure = figure_json(price_graph_skeleton())
+
+
+def update_graph(state, cube, selected_category, selected_age_cat):
+    # Precomputed per dropdown combination; only filtered selections are computed here
+    graph = state.graphs.get((selected_category, selected_age_cat)) if cube is state.cube else None
+    if graph is None:
+        graph = price_graph_data(cube, selected_category, selected_age_cat, state.current_quarter)
+    return graph
+
+
+def graph_traces(graph):
+    # y values of the traces of the skeleton, in their order
+    return [graph['bands'][name] for name in band_traces] + [graph['y']]
 
 
+def graph_patch(graph):
+    # Only the data and the range change, everything else stays as in the skeleton
+    patch = Patch()
+    for trace, y in enumerate(graph_traces(graph)):
+        patch['data'][trace]['x'] = graph['x']
+        patch['data'][trace]['y'] = y
+    patch['layout']['yaxis']['range'] = graph['range']
+    return patch
 
 
+def graph_figure(graph):
+    # The skeleton with the data filled in, for the prerendered layout
+    figure = copy.deepcopy(price_graph_figure)
+    for trace, y in enumerate(graph_traces(graph)):
+        figure['data'][trace]['x'] = graph['x']
+        figure['data'][trace]['y'] = y
+    figure['layout']['yaxis']['range'] = graph['range']
+    return figure
+
+
+def update_data_alert(kpis):
+    # Number of sales of the selected segment in the current quarter
+    count = kpis['count']
+
+    if count < 10:
+        return html.Div(alert_text, style=alert_style)
+    return ''
+
+
+def client_percentage(value):
+    # Rounded like the server's f'{value:.2f}' (ties to even), which JavaScript's toFixed()
+    # does not do; values that round to zero keep their sign for the colour
+    if value is None or round(value, 2) == 0:
+        return value
+    return round(value, 2)
+
+
+def client_store(state):
+    # Everything the clientside callback needs in columnar form: the lists below have one entry
+    # per dropdown combination, the prices one entry per chart quarter (None without sales)
+    quarters = chart_quarters(state.current_quarter)
+    segments = [(category, age_cat)
+                for category in state.options['Kategorie'] + [TOTAL]
+                for age_cat in state.options['fahrzeugalter_cat'] + [TOTAL]
+                if state.current_quarter is not None]
+    kpis = [segment_kpis(state, state.cube, state.price_index, category, age_cat) for category, age_cat in segments]
+    prices = []
+    bands = {name: [] for name in band_traces}
+    for category, age_cat in segments:
+        values = [lookup(state.cube, category, age_cat, quarter) for quarter in quarters]
+        prices.append([value['Verkaufspreis'] / 1000 if value else None for value in values])
+        for name in band_traces:
+            bands[name].append([value['percentiles'][name] / 1000 if value else None for value in values])
+    return {
+        'category': [category for category, _ in segments],
+        'age_cat': [age_cat for _, age_cat in segments],
+        'median_price': [values['median_price'] for values in kpis],
+        'count': [values['count'] for values in kpis],
+        **{column: [client_percentage(values[column]) for values in kpis]
+           for column in ['diff_previous_year', 'diff_previous_quarter', 'diff_wunschpreis']},
+        'labels': {column: kpis[0][column] for column in ['current_quarter', 'previous_year_quarter', 'previous_quarter']} if kpis else {},
+        'quarters': quarters,
+        'prices': prices,
+        'band_traces': band_traces,
+        'bands': bands,
+        # Figure without data and the styles, so the browser renders exactly what the server would
+        'figure': price_graph_figure,
+        'styles': {'tile': tile_style, 'number': number_style, 'alert': alert_style},
+        'alert_text': alert_text,
+    }
 
-@app.callback(
+
+# Tiles, price graph and data alert all depend on the same selection, so a single callback
+# resolves it once per interaction (one request, one query) and renders all of them from it
+selection_outputs = [
+    Output('tile-1', 'children'),
+    Output('tile-2', 'children'),
+    Output('tile-3', 'children'),
+    Output('tile-4', 'children'),
+    Output('price-graph', 'figure'),
     Output('data-alert', 'children'),
+]
+
+
+def update_selection(selected_category, selected_age_cat, *extra_filters):
+    *tiles, graph, alert = cached_selection(current_state(), selected_category, selected_age_cat, extra_filters)
+    return (*tiles, graph_patch(graph), alert)
+
+
+def cached_selection(state, selected_category, selected_age_cat, extra_filters):
+    # Shared by the callback and the prerendered layout, so a deep-linked selection is
+    # rendered once and then served from the cache to both
+    key = cache_key('update_selection', state.version, selected_category, selected_age_cat, *extra_filters)
+    return result_cache.get_or_compute(key, lambda: render_selection(state, selected_category, selected_age_cat, extra_filters))
+
+
+def render_selection(state, selected_category, selected_age_cat, extra_filters):
+    cube, price_index = query_segment(state, selected_category, selected_age_cat, extra_filters)
+    kpis = segment_kpis(state, cube, price_index, selected_category, selected_age_cat)
+    return (
+        *update_tiles(kpis),
+        update_graph(state, cube, selected_category, selected_age_cat),
+        update_data_alert(kpis),
+    )
+
+
+def id_clone(component, children=None):
+    # The component with only its id and required props, as in Dash's own validation layout
+    # for layout functions: no figures, options or children to ship in every page's config
+    cls = type(component)
+    signature = getattr(cls.__init__, '__signature__', None)
+    props = {prop: getattr(component, prop) for prop in component._prop_names
+             if hasattr(component, prop)
+             and (prop == 'id' or signature is None or signature.parameters[prop].default == component.REQUIRED)}
+    if children:
+        props['children'] = children
+    return cls(**props)
+
+def validation_layout():
+    layout = build_layout(empty_state())
+    return id_clone(layout, [id_clone(component) for component in layout._traverse_ids()])
+
+# Dash validates a layout function by calling it once; validate against an empty layout
+# instead so importing the app never has to wait for the data
+app.validation_layout = validation_layout()
+app.layout = serve_layout
+
+def selection_prices(state, selected_category, selected_age_cat, extra_filters):
+    # Sorted prices of the selection in the current quarter, None without sales or without
+    # individual prices. Not via query_segment(): the planner would count the request and might
+    # materialise it in the process of the background job, where neither is kept.
+    if state.price_index is None:
+        return None
+    if not filter_key(extra_filters):
+        return state.price_index.get((selected_category, selected_age_cat), {}).get(state.current_quarter)
+    return state.planner.quarter_prices(selected_category, selected_age_cat, extra_filters, state.current_quarter)
+
+def update_confidence_interval(set_progress, n_clicks, selected_category, selected_age_cat, *extra_filters):
+    # Bootstrap confidence interval of the current quarter's median price of the selection
+    state = current_state()
+    label = f"{selected_category} / {selected_age_cat} ({quarter_label(state.current_quarter)})"
+    quarter_prices = selection_prices(state, selected_category, selected_age_cat, extra_filters)
+    if quarter_prices is None:
+        # No sales, or no individual prices (streaming or bundle mode)
+        return f"{label}: Für diese Auswahl liegen keine Einzelpreise vor."
+    interval = bootstrap_median_ci(quarter_prices['Verkaufspreis'],
+                                   progress=lambda done, total: set_progress((str(done), str(total))))
+    if interval is None:
+        return f"{label}: Zu wenige Verkäufe für ein Konfidenzintervall."
+    lower, upper = interval
+    return f"{label}: 95%-Konfidenzintervall des Medianpreises {format_number(round(lower))} € – {format_number(round(upper))} €"
+
+
+confidence_interval_dependencies = [
+    Output('ci-result', 'children'),
+    [Input('ci-button', 'n_clicks'),
+     State('category-dropdown', 'value'),
+     State('age-cat-dropdown', 'value'),
+     *[State(f'{column}-dropdown', 'value') for column in EXTRA_FILTERS]],
+]
+
+if diskcache is not None:
+    background_manager = DiskcacheManager(
+        diskcache.Cache(BACKGROUND_DIR),
+        cache_by=[lambda: current_state().version],
+        expire=CACHE_TTL,
+    )
+    app.callback(
+        *confidence_interval_dependencies,
+        background=True,
+        manager=background_manager,
+        cache_args_to_ignore=[0],  # n_clicks, so repeated clicks are served from the cache
+        progress=[Output('ci-progress', 'value'), Output('ci-progress', 'max')],
+        running=[(Output('ci-button', 'disabled'), True, False)],
+        prevent_initial_call=True
+    )(update_confidence_interval)
+else:
+    app.callback(
+        *confidence_interval_dependencies,
+        prevent_initial_call=True
+    )(lambda *args: update_confidence_interval(lambda progress: None, *args))
+
+# The initial selection is already rendered into the layout, so neither callback runs on page load
+if CLIENTSIDE:
+    app.clientside_callback(
+        ClientsideFunction(namespace='priceanalyzer', function_name='update_selection'),
+        selection_outputs,
+        [Input('category-dropdown', 'value'),
+         Input('age-cat-dropdown', 'value'),
+         State('segment-store', 'data')],
+        prevent_initial_call=True
+    )
+else:
+    app.callback(
+        selection_outputs,
+        [Input('category-dropdown', 'value'),
+         Input('age-cat-dropdown', 'value'),
+         *[Input(f'{column}-dropdown', 'value') for column in EXTRA_FILTERS]],
+        prevent_initial_call=True
+    )(update_selection)
+
+# Keep the selection in the URL, so the page can be bookmarked or shared and is prerendered
+# with it (see requested_selection)
+app.clientside_callback(
+    ClientsideFunction(namespace='priceanalyzer', function_name='selection_search'),
+    Output('url', 'search'),
     [Input('category-dropdown', 'value'),
-     Input('age-cat-dropdown', 'value'),]
+     Input('age-cat-dropdown', 'value'),
+     *[Input(f'{column}-dropdown', 'value') for column in EXTRA_FILTERS]],
+    prevent_initial_call=True
 )
-def update_data_alert(selected_category, selected_age_cat):
-    filtered_data = data.copy()
-    # Apply the same filters as in your other callbacks
-    if selected_category != 'Total':
-        filtered_data = filtered_data[filtered_data['Kategorie'] == selected_category]
-    if selected_age_cat != 'Total':
-        filtered_data = filtered_data[filtered_data['fahrzeugalter_cat'] == selected_age_cat]
-
-
-    # Filter data for Q4
-    q4_data = filtered_data[filtered_data['Quarter'] == '2023Q4']  # Adjust the year as needed
-
-    # Check the number of entries in Q4
-    if len(q4_data) < 10:
-        return html.Div('Hinweis: Für das letzte Quartal liegen uns zu wenige Daten vor. Bitte wählen Sie weniger Parameter.', 
-                        style={'color': 'red', 
-                               'fontWeight': 'bold', 
-                               'fontSize': '17px', 
-                               'display': 'left', 
-                               'alignItems': 'left', 
-                               'justifyContent': 'left',
-                               'height': '100%'})
-    return ''
 
 
 
@@ -0,0 +1,120 @@
+// Clientside callbacks of app.py.
+//
+// update_selection is the clientside version of the server callback (PRICEANALYZER_CLIENTSIDE=1):
+// it renders tiles, price graph and data alert from the values shipped in the segment-store,
+// without a request. Keep the markup in sync with update_tiles, update_graph and update_data_alert.
+
+function div(children, style) {
+    return {namespace: 'dash_html_components', type: 'Div', props: {children: children, style: style}};
+}
+
+function strong(text) {
+    return {namespace: 'dash_html_components', type: 'Strong', props: {children: text}};
+}
+
+function span(text, style) {
+    return {namespace: 'dash_html_components', type: 'Span', props: {children: text, style: style}};
+}
+
+function getColor(value) {
+    if (value === null) {
+        return '#000000';
+    }
+    return value < 0 ? '#ff0000' : '#008000';
+}
+
+function formatNumber(value) {
+    return String(value).replace(/\B(?=(\d{3})+(?!\d))/g, '.');
+}
+
+function percentage(value) {
+    if (value === null) {
+        return 'Data not available';
+    }
+    return span(value.toFixed(2) + '%', {color: getColor(value)});
+}
+
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    priceanalyzer: {
+        update_selection: function (category, ageCat, store) {
+            let row = -1;
+            for (let i = 0; i < store.category.length; i++) {
+                if (store.category[i] === category && store.age_cat[i] === ageCat) {
+                    row = i;
+                    break;
+                }
+            }
+            const value = (column) => (row >= 0 ? store[column][row] : null);
+            const styles = store.styles;
+            const labels = store.labels;
+            const medianPrice = value('median_price');
+
+            const tiles = [
+                div([
+                    div(strong('Händlereinkaufspreis'), {'margin-bottom': '5px'}),
+                    div('(' + labels.current_quarter + '):', {'margin-bottom': '10px'}),
+                    div(medianPrice ? formatNumber(medianPrice) + ' €' : 'Data not available', styles.number),
+                ], styles.tile),
+                div([
+                    div(strong('Trend (Vorjahr)'), {'margin-bottom': '5px'}),
+                    div('(vs. ' + labels.previous_year_quarter + '):', {'margin-bottom': '10px'}),
+                    div(percentage(value('diff_previous_year')), styles.number),
+                ], styles.tile),
+                div([
+                    div(strong('Trend (letztes Quartal)'), {'margin-bottom': '5px'}),
+                    div('(vs. ' + labels.previous_quarter + '):', {'margin-bottom': '10px'}),
+                    div(percentage(value('diff_previous_quarter')), styles.number),
+                ], styles.tile),
+                div([
+                    div(strong('Verhandlungsspielraum'), {'margin-bottom': '5px', 'padding': '0'}),
+                    div('(Angebots- zu Einkaufspreis):', {'margin-bottom': '10px', 'font-size': '90%'}),
+                    div(percentage(value('diff_wunschpreis')), styles.number),
+                ], styles.tile),
+            ];
+
+            // Median and percentile bands per quarter over the chart window, skipping quarters
+            // without sales; the traces are the bands (in store.band_traces order), then the median
+            const quarters = [];
+            const prices = [];
+            const bands = store.band_traces.map(() => []);
+            const segmentPrices = row >= 0 ? store.prices[row] : [];
+            segmentPrices.forEach(function (price, i) {
+                if (price !== null) {
+                    quarters.push(store.quarters[i]);
+                    prices.push(price);
+                    store.band_traces.forEach(function (name, j) {
+                        bands[j].push(store.bands[name][row][i]);
+                    });
+                }
+            });
+            const figure = JSON.parse(JSON.stringify(store.figure));
+            bands.concat([prices]).forEach(function (values, i) {
+                figure.data[i].x = quarters;
+                figure.data[i].y = values;
+            });
+            const lowest = bands[store.band_traces.indexOf('P10')];
+            const highest = bands[store.band_traces.indexOf('P90')];
+            figure.layout.yaxis.range = prices.length
+                ? [Math.max(0, Math.min.apply(null, lowest) - 10), Math.max.apply(null, highest) + 10]
+                : [null, null];
+
+            const alert = (value('count') || 0) < 10 ? div(store.alert_text, styles.alert) : '';
+
+            return tiles.concat([figure, alert]);
+        },
+
+        // Query string of the selection (see requested_selection in app.py), without 'Total' values
+        selection_search: function (category, ageCat, ...extraFilters) {
+            const columns = ['Kategorie', 'fahrzeugalter_cat', 'Kilometer_cat', 'region', 'Bundesland',
+                'Getriebeart', 'Chassis', 'Marke'];
+            const params = new URLSearchParams();
+            [category, ageCat].concat(extraFilters).forEach(function (value, i) {
+                if (value && value !== 'Total') {
+                    params.set(columns[i], value);
+                }
+            });
+            const search = params.toString();
+            return search ? '?' + search : '';
+        },
+    },
+});
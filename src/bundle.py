@@ -0,0 +1,48 @@
+import json
+import os
+from datetime import datetime, timezone
+
+import plotly
+
+# Bump when the layout of the bundle changes; the web process refuses bundles of another format
+BUNDLE_FORMAT = 4
+
+
+def write_bundle(state, path):
+    # Everything the web process needs, precomputed: cube, tile values and price graph data
+    # per dropdown combination and the static figures as plotly JSON
+    bundle = {
+        'format': BUNDLE_FORMAT,
+        'version': state.version,
+        'source': os.path.basename(state.source),
+        'deltas': [os.path.basename(delta) for delta in state.deltas],
+        'built_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'options': state.options,
+        'current_quarter': state.current_quarter,
+        'cube': [[category, age_cat, quarters] for (category, age_cat), quarters in state.cube.items()],
+        'kpis': [[category, age_cat, values] for (category, age_cat), values in state.kpis.items()],
+        'graphs': [[category, age_cat, graph] for (category, age_cat), graph in state.graphs.items()],
+        'figures': state.figures,
+    }
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(bundle, f, cls=plotly.utils.PlotlyJSONEncoder, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def read_bundle(path):
+    # The bundle's contents in the shape of the DashboardState fields
+    with open(path, encoding='utf-8') as f:
+        bundle = json.load(f)
+    if bundle.get('format') != BUNDLE_FORMAT:
+        raise ValueError(f"{path} has bundle format {bundle.get('format')}, expected {BUNDLE_FORMAT}")
+    return {
+        'version': bundle['version'],
+        'deltas': tuple(bundle['deltas']),
+        'options': bundle['options'],
+        'current_quarter': bundle['current_quarter'],
+        'cube': {(category, age_cat): quarters for category, age_cat, quarters in bundle['cube']},
+        'kpis': {(category, age_cat): values for category, age_cat, values in bundle['kpis']},
+        'graphs': {(category, age_cat): graph for category, age_cat, graph in bundle['graphs']},
+        'figures': bundle['figures'],
+    }
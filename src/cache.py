@@ -0,0 +1,166 @@
+import hashlib
+import os
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+# Backend for cached callback results: 'memory' (per process), 'disk' (a directory shared by
+# all workers on the host), 'redis' (a key-value server, needs the redis package) or 'off'
+CACHE_BACKEND = os.environ.get('PRICEANALYZER_CACHE', 'memory')
+CACHE_SIZE = int(os.environ.get('PRICEANALYZER_CACHE_SIZE', '512'))
+CACHE_TTL = float(os.environ.get('PRICEANALYZER_CACHE_TTL', '3600'))
+CACHE_DIR = os.environ.get('PRICEANALYZER_CACHE_DIR', '.cache')
+REDIS_URL = os.environ.get('PRICEANALYZER_REDIS_URL', 'redis://localhost:6379/0')
+
+MISSING = object()
+
+
+def cache_key(*parts):
+    # Callers include the dataset version, so a reloaded export never hits results of the
+    # previous one; those are evicted by LRU/TTL like any other entry
+    return hashlib.sha256(repr(parts).encode()).hexdigest()
+
+
+class MemoryCache:
+    # LRU with TTL in an OrderedDict, most recently used last
+
+    def __init__(self, size=CACHE_SIZE, ttl=CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return MISSING
+            if entry[0] < time.monotonic():
+                del self.entries[key]
+                return MISSING
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class DiskCache:
+    # One pickle file per entry; the modification time is refreshed on every hit, so it
+    # serves for both TTL (age since last use) and LRU eviction
+
+    def __init__(self, directory=CACHE_DIR, size=CACHE_SIZE, ttl=CACHE_TTL):
+        self.directory = directory
+        self.size = size
+        self.ttl = ttl
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.directory, f'{key}.pickle')
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            if os.path.getmtime(path) + self.ttl < time.time():
+                os.remove(path)
+                return MISSING
+            with open(path, 'rb') as f:
+                value = pickle.load(f)
+            os.utime(path)
+            return value
+        except (OSError, EOFError, pickle.UnpicklingError):
+            # Missing, or removed or replaced by another worker in the meantime
+            return MISSING
+
+    def set(self, key, value):
+        path = self.path(key)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+        self.evict()
+
+    def evict(self):
+        entries = [entry for entry in os.scandir(self.directory) if entry.name.endswith('.pickle')]
+        if len(entries) <= self.size:
+            return
+        entries.sort(key=lambda entry: entry.stat().st_mtime)
+        for entry in entries[:len(entries) - self.size]:
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
+
+    def __len__(self):
+        return sum(1 for entry in os.scandir(self.directory) if entry.name.endswith('.pickle'))
+
+
+class RedisCache:
+    # Entries expire after the TTL; LRU eviction is left to the server
+    # (maxmemory-policy allkeys-lru)
+
+    def __init__(self, url=REDIS_URL, ttl=CACHE_TTL):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+
+    def get(self, key):
+        value = self.client.get(f'priceanalyzer:{key}')
+        return MISSING if value is None else pickle.loads(value)
+
+    def set(self, key, value):
+        self.client.set(f'priceanalyzer:{key}', pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL), ex=int(self.ttl))
+
+    def __len__(self):
+        return self.client.dbsize()
+
+
+class NoCache:
+
+    def get(self, key):
+        return MISSING
+
+    def set(self, key, value):
+        pass
+
+    def __len__(self):
+        return 0
+
+
+BACKENDS = {'memory': MemoryCache, 'disk': DiskCache, 'redis': RedisCache, 'off': NoCache}
+
+
+class ResultCache:
+    # Backend plus hit/miss counters of this process
+
+    def __init__(self, backend=CACHE_BACKEND):
+        self.backend_name = backend
+        self.backend = BACKENDS[backend]()
+        self.hits = 0
+        self.misses = 0
+
+    def get_or_compute(self, key, compute):
+        value = self.backend.get(key)
+        if value is not MISSING:
+            self.hits += 1
+            return value
+        self.misses += 1
+        value = compute()
+        self.backend.set(key, value)
+        return value
+
+    def stats(self):
+        return {
+            'backend': self.backend_name,
+            'entries': len(self.backend),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
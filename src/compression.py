@@ -0,0 +1,127 @@
+import gzip
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+from flask import request
+
+try:
+    import brotli
+except ImportError:
+    # Brotli is optional; without it responses are gzipped only
+    brotli = None
+
+# Responses smaller than COMPRESS_MIN_SIZE bytes are sent as they are, compression would
+# not pay off. PRICEANALYZER_COMPRESS=0 turns compression off (e.g. behind a compressing proxy).
+COMPRESS = os.environ.get('PRICEANALYZER_COMPRESS', '1') == '1'
+COMPRESS_MIN_SIZE = int(os.environ.get('PRICEANALYZER_COMPRESS_MIN_SIZE', '1024'))
+COMPRESS_LEVEL = {'br': 5, 'gzip': 6}
+STATIC_COMPRESS_LEVEL = {'br': 9, 'gzip': 9}  # br 11 takes seconds for plotly.min.js
+COMPRESSIBLE_TYPES = {
+    'application/json', 'application/javascript', 'text/javascript', 'text/html',
+    'text/css', 'text/plain', 'text/csv', 'image/svg+xml',
+}
+
+# Static files (the Dash and Plotly JS bundles, assets) are the same for every request, so
+# they are compressed once, at a higher level, and kept here
+STATIC_PREFIXES = ('/_dash-component-suites/', '/assets/')
+STATIC_CACHE_SIZE = 64
+
+
+def compress(data, encoding, level):
+    if encoding == 'br':
+        return brotli.compress(data, quality=level)
+    return gzip.compress(data, compresslevel=level, mtime=0)
+
+
+def encoded_etag(etag, encoding):
+    # ETag of the compressed representation of a response
+    return f'{etag}-{encoding}'
+
+
+class ResponseCompressor:
+    # after_request hook compressing responses for clients that accept it, with counters for /metrics
+
+    def __init__(self):
+        self.static_cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {'compressed': 0, 'skipped': 0, 'bytes_in': 0, 'bytes_out': 0, 'static_hits': 0}
+
+    def init_app(self, server):
+        if COMPRESS:
+            server.after_request(self.after_request)
+
+    def accepted_encoding(self):
+        accepted = request.accept_encodings
+        if brotli is not None and accepted['br']:
+            return 'br'
+        if accepted['gzip']:
+            return 'gzip'
+        return None
+
+    def after_request(self, response):
+        encoding = self.accepted_encoding()
+        if (encoding is None
+                or response.status_code != 200
+                or (response.is_streamed and not response.direct_passthrough)
+                or 'Content-Encoding' in response.headers
+                or response.mimetype not in COMPRESSIBLE_TYPES):
+            return response
+
+        # Static files are served as file wrappers; read them so the body can be compressed
+        response.direct_passthrough = False
+        data = response.get_data()
+        if len(data) < COMPRESS_MIN_SIZE:
+            self.count('skipped')
+            return response
+
+        if request.path.startswith(STATIC_PREFIXES):
+            body = self.compress_static(response, data, encoding)
+        else:
+            body = compress(data, encoding, COMPRESS_LEVEL[encoding])
+
+        with self.lock:
+            self.stats['compressed'] += 1
+            self.stats['bytes_in'] += len(data)
+            self.stats['bytes_out'] += len(body)
+        response.set_data(body)
+        response.headers['Content-Encoding'] = encoding
+        response.vary.add('Accept-Encoding')
+        etag, weak = response.get_etag()
+        if etag:
+            # The compressed body is a different representation than the uncompressed one;
+            # answer conditional requests for it with 304 like Flask does for the original
+            response.set_etag(encoded_etag(etag, encoding), weak)
+            response.make_conditional(request)
+        return response
+
+    def compress_static(self, response, data, encoding):
+        # Keyed by the file's ETag (derived from its modification time and size) where there is one
+        etag, _ = response.get_etag()
+        key = (request.path, etag or hashlib.sha256(data).hexdigest(), encoding)
+        with self.lock:
+            body = self.static_cache.get(key)
+            if body is not None:
+                self.static_cache.move_to_end(key)
+                self.stats['static_hits'] += 1
+                return body
+        body = compress(data, encoding, STATIC_COMPRESS_LEVEL[encoding])
+        with self.lock:
+            self.static_cache[key] = body
+            while len(self.static_cache) > STATIC_CACHE_SIZE:
+                self.static_cache.popitem(last=False)
+        return body
+
+    def count(self, name):
+        with self.lock:
+            self.stats[name] += 1
+
+    def metrics(self):
+        with self.lock:
+            stats = dict(self.stats)
+        stats['enabled'] = COMPRESS
+        stats['brotli'] = brotli is not None
+        stats['static_cached'] = len(self.static_cache)
+        stats['ratio'] = round(stats['bytes_out'] / stats['bytes_in'], 3) if stats['bytes_in'] else None
+        return stats
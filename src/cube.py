@@ -0,0 +1,288 @@
+import numpy as np
+import pandas as pd
+
+TOTAL = 'Total'
+
+# Price columns aggregated per cell
+MEASURES = ['Verkaufspreis', 'Wunschpreis']
+
+# Percentiles of the Verkaufspreis kept per cell, for the bands of the price graph
+BAND_PERCENTILES = {'P10': 0.10, 'P25': 0.25, 'P75': 0.75, 'P90': 0.90}
+
+# Roll-up levels of the cube: the dimensions listed are kept, the others are aggregated to 'Total'
+ROLLUP_LEVELS = [
+    ['Kategorie', 'fahrzeugalter_cat'],
+    ['Kategorie'],
+    ['fahrzeugalter_cat'],
+    [],
+]
+
+
+def run_quantiles(values, starts, counts, q):
+    # Quantile q of each sorted run values[start:start + count] (count > 0), interpolating
+    # like windows.sorted_quantile
+    position = q * (counts - 1)
+    lower = position.astype(np.int64)
+    upper = np.minimum(lower + 1, counts - 1)
+    low = values[starts + lower]
+    return low + (values[starts + upper] - low) * (position - lower)
+
+
+def run_medians(values, starts, counts):
+    # Median of each sorted run values[start:start + count], NaN for empty runs
+    medians = np.full(len(counts), np.nan)
+    nonempty = counts > 0
+    starts, counts = starts[nonempty], counts[nonempty]
+    lower = values[starts + (counts - 1) // 2]
+    upper = values[starts + counts // 2]
+    medians[nonempty] = (lower.astype(np.float64) + upper) / 2
+    return medians
+
+
+def sorted_cells(data):
+    # Every cell of the cube (segment and quarter, including the 'Total' roll-ups) with its prices
+    # sorted, in one pass per measure: the rows are sorted by price once, then per roll-up level
+    # stably by cell code (a radix sort for small codes), so the prices of each cell form a sorted
+    # run of one array. The medians of all cells are read off the runs by position at once.
+    # Returns (segment, quarter, count, {measure: median}, {percentile: Verkaufspreis},
+    # {measure: sorted prices}) per cell with sales, by roll-up level, then segment, then
+    # quarter in ascending order.
+    has_quarter = data['Quarter'].notna().to_numpy()
+    _, first_rows, quarter_codes = np.unique(data['Quarter'].array.asi8, return_index=True, return_inverse=True)
+    quarters = [str(data['Quarter'].iat[row]) for row in first_rows]
+    prices = {measure: data[measure].to_numpy() for measure in MEASURES}
+    price_orders = {measure: np.argsort(values) for measure, values in prices.items()}
+
+    cells = []
+    for dims in ROLLUP_LEVELS:
+        # Cell code (kategorie * n_age_cats + age_cat) * n_quarters + quarter, where dimensions
+        # rolled up to 'Total' count as a single value; rows with a missing value are left out
+        code = quarter_codes.astype(np.int64)
+        included = has_quarter.copy()
+        size = len(quarters)
+        names = {}
+        for column in ['fahrzeugalter_cat', 'Kategorie']:
+            if column in dims:
+                codes = data[column].cat.codes.to_numpy()
+                included &= codes >= 0
+                code += codes.astype(np.int64) * size
+                names[column] = [str(value) for value in data[column].cat.categories]
+                size *= len(names[column])
+        counts = np.bincount(code[included], minlength=size)
+        occupied = np.flatnonzero(counts)
+        code_type = np.uint16 if size <= np.iinfo(np.uint16).max else np.int64
+
+        runs = {}
+        run_starts = {}
+        run_counts = {}
+        medians = {}
+        for measure in MEASURES:
+            # A missing price (a blank Wunschpreis) is left out of its run, like median() skips it
+            priced = included & ~np.isnan(prices[measure])
+            order = price_orders[measure]
+            order = order[priced[order]]
+            order = order[np.argsort(code[order].astype(code_type), kind='stable')]
+            runs[measure] = prices[measure][order]
+            priced_counts = np.bincount(code[priced], minlength=size)
+            run_starts[measure] = (np.cumsum(priced_counts) - priced_counts)[occupied]
+            run_counts[measure] = priced_counts[occupied]
+            medians[measure] = run_medians(runs[measure], run_starts[measure], run_counts[measure])
+        # Every row has a Verkaufspreis (see dataload.clean), so its runs hold all rows of a cell
+        percentiles = {name: run_quantiles(runs['Verkaufspreis'], run_starts['Verkaufspreis'], counts[occupied], q)
+                       for name, q in BAND_PERCENTILES.items()}
+
+        for position, cell in enumerate(occupied):
+            rest, quarter = divmod(int(cell), len(quarters))
+            rest, age_cat = divmod(rest, len(names.get('fahrzeugalter_cat', [TOTAL])))
+            segment = (names.get('Kategorie', [TOTAL])[rest], names.get('fahrzeugalter_cat', [TOTAL])[age_cat])
+            cells.append((
+                segment,
+                quarters[quarter],
+                int(counts[cell]),
+                {measure: float(medians[measure][position]) for measure in MEASURES},
+                {name: float(values[position]) for name, values in percentiles.items()},
+                {measure: runs[measure][run_starts[measure][position]:run_starts[measure][position] + run_counts[measure][position]]
+                 for measure in MEASURES},
+            ))
+    return cells
+
+
+def cube_from_cells(cells):
+    # Median Verkaufspreis, median Wunschpreis, number of sales and the BAND_PERCENTILES of the
+    # Verkaufspreis per (Kategorie, fahrzeugalter_cat) segment and quarter, including the
+    # 'Total' roll-ups: {(kategorie, fahrzeugalter_cat): {'2023Q4': {'Verkaufspreis': ...,
+    # 'Wunschpreis': ..., 'count': ..., 'percentiles': {'P10': ..., ...}}}}
+    # Quarters are stored in ascending order for every segment.
+    cube = {}
+    for segment, quarter, count, medians, percentiles, _ in cells:
+        cube.setdefault(segment, {})[quarter] = {
+            'Verkaufspreis': medians['Verkaufspreis'],
+            'Wunschpreis': medians['Wunschpreis'],
+            'count': count,
+            'percentiles': percentiles,
+        }
+    return cube
+
+
+def segment_order(data):
+    # Sort key putting segments in the order sorted_cells(data) gives them: by roll-up level,
+    # then by the category codes of the dimensions kept
+    codes = {column: {str(value): code for code, value in enumerate(data[column].cat.categories)}
+             for column in ROLLUP_LEVELS[0]}
+
+    def key(segment):
+        values = dict(zip(ROLLUP_LEVELS[0], segment))
+        dims = [column for column in ROLLUP_LEVELS[0] if values[column] != TOTAL]
+        return (ROLLUP_LEVELS.index(dims), *(codes[column].get(values[column], -1) if column in dims else 0
+                                             for column in ROLLUP_LEVELS[0]))
+    return key
+
+
+def update_cube(cube, partial, quarters, order):
+    # Replace the given quarters (e.g. those touched by a delta export) by those of partial, the
+    # cube of their rows, and return a new cube; the old one stays untouched for callbacks that
+    # are still using it. The segments are sorted with order (see segment_order), so the result
+    # is the same as a cube built from all rows.
+    quarters = set(str(quarter) for quarter in quarters)
+    updated = {}
+    for segment in sorted(cube.keys() | partial.keys(), key=order):
+        merged = {quarter: values for quarter, values in cube.get(segment, {}).items() if quarter not in quarters}
+        merged.update(partial.get(segment, {}))
+        if merged:
+            updated[segment] = dict(sorted(merged.items()))
+    return updated
+
+
+def lookup(cube, category, age_cat, quarter):
+    # Aggregates of one segment in one quarter, None if there were no sales
+    return cube.get((category, age_cat), {}).get(str(quarter))
+
+
+def segment_series(cube, category, age_cat):
+    # All quarters of one segment as (quarter, aggregates) pairs in ascending order
+    return list(cube.get((category, age_cat), {}).items())
+
+
+# Streaming aggregation keeps a quantile sketch per cell instead of the rows themselves, so
+# memory depends on the number of cells and not on the size of the export. The sketch is a
+# log-bucketed histogram (as in DDSketch): bucket i counts the prices in (GAMMA^(i-1), GAMMA^i],
+# so every quantile comes with a relative error of at most SKETCH_ACCURACY, and sketches of any
+# cells (quarters, categories, regions, ...) are merged by adding their counts.
+SKETCH_ACCURACY = 0.005
+SKETCH_GAMMA = (1 + SKETCH_ACCURACY) / (1 - SKETCH_ACCURACY)
+SKETCH_BUCKETS = int(np.ceil(np.log(10_000_000) / np.log(SKETCH_GAMMA))) + 1  # up to 10 Mio. €
+
+# Dimensions of a sketch cell besides the quarter: the segment and the extra filters that can be
+# answered from the sketches. Chassis and Marke have too many values to multiply the cells by.
+SKETCH_DIMENSIONS = ['Kategorie', 'fahrzeugalter_cat', 'Kilometer_cat', 'region', 'Bundesland', 'Getriebeart']
+SKETCH_KEYS = SKETCH_DIMENSIONS + ['Quarter', 'bucket']
+
+# The sketches are stored sparsely, as one table per measure with a row per cell and occupied
+# bucket (SKETCH_KEYS and count). Most cells hold a few dozen buckets, not all SKETCH_BUCKETS.
+
+
+def sketch_buckets(values):
+    # Bucket of every price (prices below 1 € count as 1 €)
+    logs = np.log(np.maximum(np.asarray(values, dtype=np.float64), 1)) / np.log(SKETCH_GAMMA)
+    return np.minimum(np.ceil(logs).astype(np.int64), SKETCH_BUCKETS - 1)
+
+
+def merge_sketches(tables, keys=SKETCH_KEYS):
+    # One sketch table with the counts of equal keys added up, sorted by the keys
+    table = pd.concat(tables, ignore_index=True)
+    return table.groupby(keys, sort=True, dropna=False)['count'].sum().reset_index()
+
+
+def sketch_quantiles(buckets, counts, sizes, q):
+    # Quantile q of consecutive sketches of sizes[i] entries each (buckets ascending within a
+    # sketch), interpolating between ranks like np.quantile
+    cumulative = np.cumsum(counts)
+    ends = np.cumsum(sizes)
+    before = np.concatenate([[0], cumulative])[ends - sizes]
+    totals = cumulative[ends - 1] - before
+
+    def value_at(rank):
+        # Every value of a bucket is within SKETCH_ACCURACY of this estimate
+        index = np.searchsorted(cumulative, before + rank, side='right')
+        return 2 * SKETCH_GAMMA ** buckets[index] / (SKETCH_GAMMA + 1)
+
+    position = q * (totals - 1)
+    lower = position.astype(np.int64)
+    upper = np.minimum(lower + 1, totals - 1)
+    return value_at(lower) + (value_at(upper) - value_at(lower)) * (position - lower)
+
+
+def fold_chunk(sketches, chunk):
+    # Add the rows of one cleaned chunk to the sketch tables ({measure: table}). Rows without a
+    # quarter are left out as in sorted_cells(); missing dimension values are kept (NaN) and only
+    # count towards the roll-ups and filters that do not involve them.
+    chunk = chunk[chunk['Quarter'].notna()]
+    for measure in MEASURES:
+        # A missing price (a blank Wunschpreis) is not added to any sketch
+        priced = chunk[chunk[measure].notna()]
+        cells = priced[SKETCH_DIMENSIONS + ['Quarter']].assign(bucket=sketch_buckets(priced[measure]))
+        table = cells.groupby(SKETCH_KEYS, observed=True, dropna=False).size().rename('count').reset_index()
+        table = table.astype({**{column: object for column in SKETCH_DIMENSIONS}, 'Quarter': str})
+        sketches[measure] = merge_sketches([sketches[measure], table]) if measure in sketches else table
+    return sketches
+
+
+def filter_sketches(sketches, filters):
+    # The sketch tables restricted to the cells matching all filters ({column: value} over
+    # SKETCH_DIMENSIONS, TOTAL or None for no filter)
+    filtered = {}
+    for measure, table in sketches.items():
+        selected = np.ones(len(table), dtype=bool)
+        for column, value in filters.items():
+            if value is not None and value != TOTAL:
+                selected &= (table[column] == value).to_numpy()
+        filtered[measure] = table[selected]
+    return filtered
+
+
+def cube_from_sketches(sketches):
+    # Cube with the same layout and order as cube_from_cells(sorted_cells(...)) from the sketch
+    # tables: per roll-up level the cells are merged into the segments at once, and the
+    # quantiles of all segments and quarters are read off the merged counts together
+    cube = {}
+    for dims in ROLLUP_LEVELS:
+        keys = dims + ['Quarter']
+        stats = {}
+        for measure in MEASURES:
+            table = sketches[measure]
+            table = table[table[dims].notna().all(axis=1)]
+            merged = table.groupby(keys + ['bucket'], sort=True)['count'].sum()
+            sizes = merged.groupby(level=keys, sort=True).size()
+            buckets, counts, sizes_array = merged.index.get_level_values('bucket').to_numpy(), merged.to_numpy(), sizes.to_numpy()
+            stats[measure] = {
+                'cells': sizes.index,
+                'count': merged.groupby(level=keys, sort=True).sum().to_numpy(),
+                'median': sketch_quantiles(buckets, counts, sizes_array, 0.5),
+            }
+            if measure == 'Verkaufspreis':
+                stats[measure]['percentiles'] = {name: sketch_quantiles(buckets, counts, sizes_array, q)
+                                                 for name, q in BAND_PERCENTILES.items()}
+        prices = stats['Verkaufspreis']
+        # Every row has a Verkaufspreis, so its table has all cells; a cell whose Wunschpreise
+        # are all missing is not in the other one
+        wunschpreis = pd.Series(stats['Wunschpreis']['median'], index=stats['Wunschpreis']['cells']).reindex(prices['cells'])
+        for position, cell in enumerate(prices['cells']):
+            cell = cell if isinstance(cell, tuple) else (cell,)
+            names = dict(zip(keys, cell))
+            segment = (names.get('Kategorie', TOTAL), names.get('fahrzeugalter_cat', TOTAL))
+            cube.setdefault(segment, {})[names['Quarter']] = {
+                'Verkaufspreis': float(prices['median'][position]),
+                'Wunschpreis': float(wunschpreis.iat[position]),
+                'count': int(prices['count'][position]),
+                'percentiles': {name: float(values[position]) for name, values in prices['percentiles'].items()},
+            }
+    return cube
+
+
+def build_sketches(chunks):
+    # Sketch tables of an iterable of cleaned chunks; only one chunk is held in memory at a time
+    sketches = {}
+    for chunk in chunks:
+        fold_chunk(sketches, chunk)
+    return sketches
+
@@ -0,0 +1,123 @@
+import hashlib
+import os
+
+import pandas as pd
+
+# Directory for the binary snapshots of the cleaned price data
+SNAPSHOT_DIR = os.environ.get('PRICEDATA_SNAPSHOT_DIR', '.snapshots')
+
+# Map the snapshot read-only instead of reading it into process memory. Columns without
+# missing values stay views on the mapped file, whose pages are shared by all workers.
+MEMORY_MAP = os.environ.get('PRICEDATA_MMAP', '0') == '1'
+
+# Bump when the schema below changes so stale snapshots are not reused
+SCHEMA_VERSION = 4
+
+# Vehicle categories that are not part of the analysis
+EXCLUDED_CATEGORIES = ['Bus', 'Wohnwagen']
+
+# Low-cardinality columns the dashboard filters and groups on, stored as categoricals
+DIMENSION_COLUMNS = [
+    'Kategorie', 'fahrzeugalter_cat', 'Kilometer_cat', 'region', 'Bundesland',
+    'Getriebeart', 'Bauart', 'Chassis', 'Marke',
+]
+
+# Columns read from the export and their dtypes; all other columns (index columns,
+# free-text model names, the precomputed Quarter string, ...) are skipped while parsing
+SCHEMA = {
+    **{column: 'category' for column in DIMENSION_COLUMNS},
+    # float32 holds whole euros exactly and, unlike int32, a blank price (NaN)
+    'Verkaufspreis': 'float32',
+    'Wunschpreis': 'float32',
+    'Km-Stand': 'float32',
+    'Leistung in kW': 'float32',
+}
+DATE_COLUMN = 'Verkauf in'
+
+
+def file_hash(path):
+    # Content hash of the source file, used as the snapshot key
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def clean(df):
+    # Drop excluded categories and sales without a Verkaufspreis, and derive the sales quarter
+    # as a native period. A missing Wunschpreis is kept and skipped by the medians.
+    data = df[~df['Kategorie'].isin(EXCLUDED_CATEGORIES) & df['Verkaufspreis'].notna()].reset_index(drop=True)
+    for column in DIMENSION_COLUMNS:
+        if column in data:
+            data[column] = data[column].cat.remove_unused_categories()
+        else:
+            # Older exports lack e.g. region and Bundesland. An empty categorical keeps the
+            # filter code uniform: no dropdown values, no bitsets, no row matches a filter.
+            data[column] = pd.Categorical([None] * len(data), categories=[])
+    data['Quarter'] = data[DATE_COLUMN].dt.to_period('Q')
+    return data
+
+
+def read_csv(path, chunksize=None):
+    # Older exports lack some of the columns, so prune with a callable instead of a fixed list
+    df = pd.read_csv(
+        path,
+        usecols=lambda column: column in SCHEMA or column == DATE_COLUMN,
+        dtype=SCHEMA,
+        parse_dates=[DATE_COLUMN],
+        date_format='%Y-%m-%d',
+        chunksize=chunksize,
+    )
+    if chunksize:
+        return (clean(chunk) for chunk in df)
+    return clean(df)
+
+
+def append_delta(data, delta):
+    # Append the cleaned rows of a delta export. Both frames need the same categories, otherwise
+    # pd.concat would turn the dimension columns back into object columns. Categories new in the
+    # delta are added after the existing ones, so the codes of the loaded rows stay as they are
+    # and only the delta is recoded.
+    data, delta = data.copy(deep=False), delta.copy(deep=False)
+    for column in DIMENSION_COLUMNS:
+        new_categories = delta[column].cat.categories.difference(data[column].cat.categories)
+        if len(new_categories):
+            data[column] = data[column].cat.add_categories(new_categories)
+        delta[column] = delta[column].cat.set_categories(data[column].cat.categories)
+    return pd.concat([data, delta], ignore_index=True)
+
+
+def snapshot_path(path, digest):
+    name = os.path.splitext(os.path.basename(path))[0]
+    return os.path.join(SNAPSHOT_DIR, f'{name}-{digest[:16]}-v{SCHEMA_VERSION}.feather')
+
+
+def read_snapshot(snapshot):
+    if MEMORY_MAP:
+        from pyarrow import feather
+        return feather.read_table(snapshot, memory_map=True).to_pandas(split_blocks=True)
+    return pd.read_feather(snapshot)
+
+
+def load_data(path, digest=None):
+    # Load the cleaned price data, preferring a Feather snapshot of the same source content.
+    # Without pyarrow the CSV is parsed on every load.
+    snapshot = snapshot_path(path, digest or file_hash(path))
+    if os.path.exists(snapshot):
+        try:
+            return read_snapshot(snapshot)
+        except ImportError:
+            return read_csv(path)
+
+    data = read_csv(path)
+    try:
+        os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+        # Write to a temporary file first so concurrent workers never read a partial snapshot
+        tmp_path = f'{snapshot}.{os.getpid()}.tmp'
+        # Uncompressed so the snapshot can be memory-mapped
+        data.to_feather(tmp_path, compression='uncompressed')
+        os.replace(tmp_path, snapshot)
+    except (ImportError, OSError):
+        pass
+    return data
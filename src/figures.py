@@ -0,0 +1,258 @@
+import json
+
+import plotly.graph_objs as go
+
+from cube import BAND_PERCENTILES, TOTAL, lookup, segment_series
+from windows import CHART_QUARTERS, window_quarters
+
+
+colors = ['#F97A1F', '#C91D42', '#1DC9A4', '#141F52', '#B3B3B3' ]
+
+#age_order = sorted(data['fahrzeugalter_cat'].unique())
+age_order = ["Bis 2 Jahre", "2 - 4 Jahre", "4 - 6 Jahre", "6 - 10 Jahre", "Über 10 Jahre"]
+
+y_values = list(range(0, 100001, 10000))  # Convert range to list
+ticktext = [str(int(value / 1000)) for value in y_values]  # Convert to simpler numbers
+
+
+def get_category_order(cube):
+    # Define a consistent category order (all categories of the export, including those
+    # without sales in the charted quarters, so colours stay stable)
+    return sorted(category for category, age_cat in cube if category != TOTAL and age_cat == TOTAL)
+
+
+def get_age_cats(cube):
+    return [age_cat for category, age_cat in cube if category == TOTAL and age_cat != TOTAL]
+
+
+def chart_quarters(current_quarter):
+    # The quarters shown in all charts: the last five up to the current quarter
+    return window_quarters(current_quarter, CHART_QUARTERS) if current_quarter else []
+
+
+def quarterly_medians(cube, category, age_cat, quarters):
+    series = [(quarter, values) for quarter, values in segment_series(cube, category, age_cat) if quarter in quarters]
+    return [quarter for quarter, _ in series], [values['Verkaufspreis'] for _, values in series]
+
+
+def quarterly_shares(cube, segments, quarters):
+    # Share (in percent) of each segment in the sales of each quarter, relative to the
+    # sales of all listed segments, as {segment: ([quarter, ...], [percentage, ...])}
+    counts = {segment: {quarter: values['count'] for quarter, values in cube.get(segment, {}).items() if quarter in quarters}
+              for segment in segments}
+    totals = {}
+    for segment_counts in counts.values():
+        for quarter, count in segment_counts.items():
+            totals[quarter] = totals.get(quarter, 0) + count
+    return {segment: (list(segment_counts), [count / totals[quarter] * 100 for quarter, count in segment_counts.items()])
+            for segment, segment_counts in counts.items()}
+
+
+def category_line_chart(cube, current_quarter):
+    # Processing for Line Chart
+    category_order = get_category_order(cube)
+    last_five_quarters = chart_quarters(current_quarter)
+
+    # Creating Line Chart
+    category_line_chart_figure = go.Figure()
+
+    for i, category in enumerate(category_order):
+        quarters, medians = quarterly_medians(cube, category, TOTAL, last_five_quarters)
+        category_line_chart_figure.add_trace(go.Scatter(
+            x=quarters,
+            y=medians,
+            mode='lines+markers',
+            name=category,
+            line=dict(color=colors[i % len(colors)])
+        ))
+
+    category_line_chart_figure.update_layout(
+        xaxis_title='Quartal',
+        yaxis_title='Medianpreis (in Tsd)',
+        legend=dict(
+            orientation='h',
+            x=0.5,
+            y=-0.3,
+            xanchor='center',
+            yanchor='top'
+        ),
+        margin=dict(l=20, r=20, t=20, b=20),
+        font=dict(family='Roboto Condensed', size=14),
+        yaxis=dict(
+            tickvals=y_values,
+            ticktext=ticktext
+        )
+    )
+    return category_line_chart_figure
+
+
+def category_stacked_bar_chart(cube, current_quarter):
+    last_five_quarters = chart_quarters(current_quarter)
+
+    # Share of each category in the number of sales per quarter instead of summing sales price
+    category_order = get_category_order(cube)
+    shares = quarterly_shares(cube, [(category, TOTAL) for category in category_order], last_five_quarters)
+
+    # Creating Stacked Bar Chart based on sales count
+    stacked_bar_chart_figure = go.Figure()
+
+    for i, category in enumerate(category_order):
+        quarters, percentages = shares[(category, TOTAL)]
+        stacked_bar_chart_figure.add_trace(go.Bar(
+            name=category,
+            x=quarters,
+            y=percentages,
+            text=[f'{x:.0f}%' for x in percentages],
+            textposition='inside',
+            marker_color=colors[i % len(colors)]
+        ))
+
+    stacked_bar_chart_figure.update_layout(
+        barmode='stack',
+        xaxis=dict(
+            title='Quartal',
+            type='category'
+        ),
+        yaxis=dict(
+            title='Prozentualer Anteil (%)',
+            tickformat=',d'
+        ),
+        legend=dict(
+            orientation='h',
+            x=0.5,
+            y=-0.3,
+            xanchor='center',
+            yanchor='top'
+        ),
+        legend_title_text='Fahrzeugkategorie',
+        margin=dict(l=20, r=20, t=20, b=20),
+        font=dict(family='Roboto Condensed', size=14) # Set font for the entire layout
+    )
+    return stacked_bar_chart_figure
+
+
+def vehicle_age_line_chart(cube, current_quarter):
+    last_five_quarters = chart_quarters(current_quarter)
+
+    # Create line chart for vehicle age categories
+    vehicle_age_line_chart_figure = go.Figure()
+
+    for i, age_cat in enumerate(age_order):
+        quarters, medians = quarterly_medians(cube, TOTAL, age_cat, last_five_quarters)
+        vehicle_age_line_chart_figure.add_trace(go.Scatter(
+            x=quarters,
+            y=medians,
+            mode='lines+markers',
+            name=age_cat,
+            line=dict(color=colors[i % len(colors)])
+        ))
+
+    vehicle_age_line_chart_figure.update_layout(
+        xaxis_title='Quartal',
+        yaxis_title='Medianpreis (in Tsd)',
+        legend=dict(
+            orientation='h',
+            x=0.5,
+            y=-0.3,
+            xanchor='center',
+            yanchor='top'
+        ),
+        margin=dict(l=20, r=20, t=20, b=70),
+        font=dict(family='Roboto Condensed', size=14)
+        # Removed manual yaxis tickvals and ticktext to allow automatic scaling
+    )
+    return vehicle_age_line_chart_figure
+
+
+def vehicle_age_stacked_bar_chart(cube, current_quarter):
+    # Filter the data for the last five quarters
+    last_five_quarters = chart_quarters(current_quarter)
+
+    # Share of each vehicle age category in the number of sales per quarter
+    shares = quarterly_shares(cube, [(TOTAL, age_cat) for age_cat in get_age_cats(cube)], last_five_quarters)
+
+    # Creating Stacked Bar Chart based on sales count for vehicle age categories
+    vehicle_age_stacked_bar_figure = go.Figure()
+
+    for i, age_cat in enumerate(age_order):
+        quarters, percentages = shares.get((TOTAL, age_cat), ([], []))
+        vehicle_age_stacked_bar_figure.add_trace(go.Bar(
+            name=age_cat,
+            x=quarters,
+            y=percentages,
+            text=[f'{x:.0f}%' for x in percentages],
+            textposition='inside',
+            marker_color=colors[i % len(colors)]
+        ))
+
+    # Update layout for the stacked bar chart to reflect counts-based percentages
+    vehicle_age_stacked_bar_figure.update_layout(
+        barmode='stack',
+        xaxis=dict(
+            title='Quartal',
+            type='category'
+        ),
+        yaxis=dict(
+            title='Prozentualer Anteil (%)',
+            tickformat=',d'
+        ),
+        legend=dict(
+            orientation='h',
+            x=0.5,
+            y=-0.3,
+            xanchor='center',
+            yanchor='top',
+            title='Fahrzeugalter Kategorie'
+        ),
+        margin=dict(l=20, r=20, t=20, b=20),
+        font=dict(family='Roboto Condensed', size=14)
+    )
+    return vehicle_age_stacked_bar_figure
+
+
+def figure_json(figure):
+    # The figure as plain JSON-ready dicts and lists. Plotly validates it once here; serialising
+    # the dict for a page load or a bundle does not go through the graph objects again.
+    return json.loads(figure.to_json())
+
+
+def build_static_figures(cube, current_quarter):
+    # The four charts below the price graph, keyed by the id of their dcc.Graph. They are
+    # built from the cube's roll-ups, so no pass over the rows is needed.
+    return {
+        'category_line_chart': figure_json(category_line_chart(cube, current_quarter)),
+        'stacked_bar_chart': figure_json(category_stacked_bar_chart(cube, current_quarter)),
+        'vehicle_age_line_chart': figure_json(vehicle_age_line_chart(cube, current_quarter)),
+        'vehicle_age_stacked_bar': figure_json(vehicle_age_stacked_bar_chart(cube, current_quarter)),
+    }
+
+
+def price_graph_data(cube, category, age_cat, current_quarter):
+    # What the price graph shows for one segment: the median (y) and the BAND_PERCENTILES of the
+    # Verkaufspreis per quarter of the chart window (x), and the y-axis range. All come from the
+    # cube, so the bands cost no pass over the rows.
+    quarters = []
+    prices = []
+    bands = {name: [] for name in BAND_PERCENTILES}
+    for quarter in chart_quarters(current_quarter):
+        values = lookup(cube, category, age_cat, quarter)
+        if values:
+            quarters.append(quarter)
+            # Adjust values to thousands for the graph
+            prices.append(values['Verkaufspreis'] / 1000)
+            for name in BAND_PERCENTILES:
+                bands[name].append(values['percentiles'][name] / 1000)
+
+    # Dynamically adjust y-axis range to the outer band, prices do not go below 0
+    min_price = max(0, min(bands['P10']) - 10) if prices else None  # Subtract 10 units from the min value
+    max_price = max(bands['P90']) + 10 if prices else None  # Add 10 units to the max value
+    return {'x': quarters, 'y': prices, 'bands': bands, 'range': [min_price, max_price]}
+
+
+def all_price_graphs(cube, options, current_quarter):
+    # Price graph data for every combination the two dropdowns can produce
+    return {
+        (category, age_cat): price_graph_data(cube, category, age_cat, current_quarter)
+        for category in options['Kategorie'] + [TOTAL]
+        for age_cat in options['fahrzeugalter_cat'] + [TOTAL]
+    }
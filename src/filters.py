@@ -0,0 +1,102 @@
+from functools import reduce
+
+import numpy as np
+
+from cube import BAND_PERCENTILES, MEASURES, TOTAL
+from windows import sorted_quantile
+
+# Dimensions the dashboard can filter on: the two segment dropdowns and the extra filters
+FILTER_DIMENSIONS = [
+    'Kategorie', 'fahrzeugalter_cat', 'Kilometer_cat', 'region', 'Bundesland',
+    'Getriebeart', 'Chassis', 'Marke',
+]
+EXTRA_FILTERS = FILTER_DIMENSIONS[2:]
+
+
+def build_filter_index(data):
+    # One packed bitset (n_rows bits, 8 rows per byte) per dimension value:
+    # {column: {value: np.uint8 array}}. Built once per state from the categorical codes,
+    # so no string comparisons are needed when a filter is applied.
+    n_rows = len(data)
+    index = {}
+    for column in FILTER_DIMENSIONS:
+        codes = data[column].cat.codes.to_numpy()
+        rows_by_code = np.split(np.argsort(codes, kind='stable'), np.cumsum(np.bincount(codes + 1)))
+        index[column] = {}
+        # rows_by_code[0] holds the missing values (code -1), which no filter value selects
+        for value, rows in zip(data[column].cat.categories, rows_by_code[1:]):
+            bits = np.zeros(n_rows, dtype=bool)
+            bits[rows] = True
+            index[column][str(value)] = np.packbits(bits)
+    return index
+
+
+def extend_filter_index(index, n_rows, delta):
+    # Filter index of n_rows already indexed rows followed by the rows of delta. Only the delta
+    # is indexed; the bits of the indexed rows are copied unchanged, except for the last partly
+    # used byte, which is packed again together with the new rows.
+    full_bytes, used_bits = divmod(n_rows, 8)
+    delta_index = build_filter_index(delta)
+    no_bits = np.zeros(len(delta), dtype=np.uint8)
+    extended = {}
+    for column in FILTER_DIMENSIONS:
+        extended[column] = {}
+        for value in index[column].keys() | delta_index[column].keys():
+            bitmap = index[column].get(value)
+            if bitmap is None:
+                bitmap = np.zeros(full_bytes + (used_bits > 0), dtype=np.uint8)
+            new_bits = delta_index[column].get(value)
+            new_bits = no_bits if new_bits is None else np.unpackbits(new_bits, count=len(delta))
+            tail = np.concatenate([np.unpackbits(bitmap[full_bytes:], count=used_bits), new_bits])
+            extended[column][value] = np.concatenate([bitmap[:full_bytes], np.packbits(tail)])
+    return extended
+
+
+def select_mask(index, filters, n_rows):
+    # Boolean mask of the rows matching all filters ({column: value}, TOTAL or None for no
+    # filter), resolved with a bitwise AND over the packed bitsets; None means every row matches
+    bitmaps = []
+    for column, value in filters.items():
+        if value is None or value == TOTAL:
+            continue
+        bitmap = index[column].get(value)
+        if bitmap is None:
+            return np.zeros(n_rows, dtype=bool)
+        bitmaps.append(bitmap)
+    if not bitmaps:
+        return None
+    return np.unpackbits(reduce(np.bitwise_and, bitmaps), count=n_rows).view(bool)
+
+
+def select_rows(index, filters, n_rows):
+    # Positions of the rows matching all filters (see select_mask), None means every row matches
+    mask = select_mask(index, filters, n_rows)
+    return None if mask is None else np.flatnonzero(mask)
+
+
+def segment_cube(data, rows, category, age_cat):
+    # Cube and price index (see cube.sorted_cells) of one segment, aggregated from the
+    # selected rows only. Both have the same layout as the full ones, so the KPI and chart code
+    # works on them unchanged. Works on views of the columns and only gathers the selected rows.
+    ordinals = data['Quarter'].array.asi8
+    prices = {measure: data[measure].to_numpy() for measure in MEASURES}
+    if rows is None:
+        rows = np.arange(len(data))
+    rows = rows[np.argsort(ordinals[rows], kind='stable')]
+    cube = {}
+    price_index = {}
+    for group in np.split(rows, np.flatnonzero(np.diff(ordinals[rows])) + 1):
+        if not len(group):
+            continue
+        quarter = str(data['Quarter'].iat[group[0]])
+        # np.sort puts missing prices (NaN) last, where they are cut off
+        arrays = {measure: np.sort(prices[measure][group]) for measure in MEASURES}
+        arrays = {measure: values[:len(values) - np.isnan(values).sum()] for measure, values in arrays.items()}
+        price_index[quarter] = arrays
+        cube[quarter] = {
+            'Verkaufspreis': float(np.median(arrays['Verkaufspreis'])),
+            'Wunschpreis': float(np.median(arrays['Wunschpreis'])) if len(arrays['Wunschpreis']) else np.nan,
+            'count': len(group),
+            'percentiles': {name: sorted_quantile(arrays['Verkaufspreis'], q) for name, q in BAND_PERCENTILES.items()},
+        }
+    return {(category, age_cat): cube}, {(category, age_cat): price_index}
@@ -0,0 +1,185 @@
+import numpy as np
+import pandas as pd
+
+from cube import MEASURES, TOTAL
+from filters import build_filter_index, select_mask
+from windows import QOQ, YOY, quarter_label, window_quarters, window_stats
+
+# The values of tile_kpis() that depend on the selection
+KPI_COLUMNS = ['median_price', 'diff_previous_year', 'diff_previous_quarter', 'diff_wunschpreis', 'count']
+
+# Columns of kpi_table(): the cube cell and the tile values for it as the current quarter
+KPI_TABLE_COLUMNS = [
+    'Kategorie', 'fahrzeugalter_cat', 'Quarter', 'Verkaufspreis', 'Wunschpreis', 'count',
+    'median_price', 'diff_previous_year', 'diff_previous_quarter', 'diff_wunschpreis',
+]
+
+
+def percentage_diff(value, reference):
+    # None without a value or reference (a median without prices is NaN)
+    if value is None or not reference or np.isnan(reference):
+        return None
+    return ((value - reference) / reference) * 100
+
+
+def percentage_diffs(values, references):
+    # percentage_diff() for whole arrays, NaN for missing values
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(references != 0, (values - references) / references * 100, np.nan)
+
+
+def tile_kpis(cube, category, age_cat, current_quarter, price_index=None, window=1):
+    # The values shown in the four tiles (and the data alert) for one segment: the `window`
+    # quarters up to the current quarter compared with the same window one quarter and one
+    # year earlier. None where the segment has no sales in the quarters involved.
+    current = window_stats(cube, price_index, category, age_cat, window_quarters(current_quarter, window))
+    previous_year = window_stats(cube, price_index, category, age_cat, window_quarters(current_quarter, window, YOY))
+    previous_q = window_stats(cube, price_index, category, age_cat, window_quarters(current_quarter, window, QOQ))
+
+    # Median-Verkaufspreis for the current quarter
+    median_price = round(current['Verkaufspreis']) if current else None
+
+    return {
+        'median_price': median_price,
+        # Percentage difference vs. the same quarter of the previous year and vs. the previous quarter
+        'diff_previous_year': percentage_diff(median_price, previous_year['Verkaufspreis'] if previous_year else None),
+        'diff_previous_quarter': percentage_diff(median_price, previous_q['Verkaufspreis'] if previous_q else None),
+        # Percentage difference between Verkaufspreis and Wunschpreis for the latest quarter
+        'diff_wunschpreis': percentage_diff(median_price, current['Wunschpreis'] if current else None),
+        'count': current['count'] if current else 0,
+        'current_quarter': quarter_label(current_quarter),
+        'previous_year_quarter': quarter_label(window_quarters(current_quarter, 1, YOY)[0]),
+        'previous_quarter': quarter_label(window_quarters(current_quarter, 1, QOQ)[0]),
+    }
+
+
+def all_tile_kpis(table, options, current_quarter):
+    # Tile values for every combination the two dropdowns can produce, read off the rows of the
+    # current quarter in kpi_table(); segments without sales in it get the empty tiles of
+    # tile_kpis()
+    labels = {
+        'current_quarter': quarter_label(current_quarter),
+        'previous_year_quarter': quarter_label(window_quarters(current_quarter, 1, YOY)[0]),
+        'previous_quarter': quarter_label(window_quarters(current_quarter, 1, QOQ)[0]),
+    }
+    rows = table.loc[table['Quarter'] == current_quarter, ['Kategorie', 'fahrzeugalter_cat', *KPI_COLUMNS]]
+    current = {
+        (category, age_cat): {column: None if isinstance(value, float) and np.isnan(value) else value
+                              for column, value in zip(KPI_COLUMNS, values)}
+        for category, age_cat, *values in rows.itertuples(index=False, name=None)
+    }
+    empty = {**{column: None for column in KPI_COLUMNS}, 'count': 0}
+    return {
+        (category, age_cat): {**current.get((category, age_cat), empty), **labels}
+        for category in options['Kategorie'] + [TOTAL]
+        for age_cat in options['fahrzeugalter_cat'] + [TOTAL]
+    }
+
+
+def kpi_table(cube):
+    # The tile values of every segment in every quarter, as a tidy table with one row per cube
+    # cell (KPI_TABLE_COLUMNS), computed for all rows at once: the comparison quarters are
+    # looked up by reindexing the medians with the quarters shifted by QOQ and YOY. The row of
+    # a segment in the current quarter has the values tile_kpis() gives for it.
+    table = pd.DataFrame(
+        [(category, age_cat, quarter, values['Verkaufspreis'], values['Wunschpreis'], values['count'])
+         for (category, age_cat), quarters in cube.items()
+         for quarter, values in quarters.items()],
+        columns=KPI_TABLE_COLUMNS[:6],
+    )
+    ordinals = pd.PeriodIndex(table['Quarter'], freq='Q').asi8
+    medians = pd.Series(table['Verkaufspreis'].to_numpy(),
+                        index=pd.MultiIndex.from_arrays([table['Kategorie'], table['fahrzeugalter_cat'], ordinals]))
+
+    def shifted(offset):
+        # Median Verkaufspreis of the same segment `offset` quarters earlier, NaN without sales
+        index = pd.MultiIndex.from_arrays([table['Kategorie'], table['fahrzeugalter_cat'], ordinals - offset])
+        return medians.reindex(index).to_numpy()
+
+    median_price = np.round(table['Verkaufspreis'].to_numpy())
+    table['median_price'] = median_price.astype(np.int64)
+    table['diff_previous_year'] = percentage_diffs(median_price, shifted(YOY))
+    table['diff_previous_quarter'] = percentage_diffs(median_price, shifted(QOQ))
+    table['diff_wunschpreis'] = percentage_diffs(median_price, table['Wunschpreis'].to_numpy())
+    return table
+
+
+def block_medians(values, selected, starts, ends):
+    # Number and median of the selected entries in each block values[start:end] of an array
+    # sorted within the blocks; selected are ascending positions into values. NaN for empty blocks.
+    first = np.searchsorted(selected, starts)
+    counts = np.searchsorted(selected, ends) - first
+    if not len(selected):
+        return counts, np.full(len(counts), np.nan)
+    lower = values[selected[np.minimum(first + (counts - 1) // 2, len(selected) - 1)]]
+    upper = values[selected[np.minimum(first + counts // 2, len(selected) - 1)]]
+    return counts, np.where(counts > 0, (lower + upper) / 2, np.nan)
+
+
+def tile_window(data, current_quarter):
+    # The rows the tiles compare, presorted for batch_tile_kpis(): Verkaufspreis of the current
+    # quarter, the previous year's and the previous quarter (in this order), sorted by price
+    # within each quarter, and Wunschpreis of the current quarter sorted by price (rows without
+    # one left out). Each comes
+    # with a filter index (see filters.build_filter_index) of its rows in that order.
+    quarters = [window_quarters(current_quarter)[0],
+                window_quarters(current_quarter, 1, YOY)[0],
+                window_quarters(current_quarter, 1, QOQ)[0]]
+    quarter_ordinals = np.array([pd.Period(quarter, freq='Q').ordinal for quarter in quarters])
+    ordinals = data['Quarter'].array.asi8
+    prices = {measure: data[measure].to_numpy().astype(np.float64) for measure in MEASURES}
+
+    rows = np.flatnonzero(np.isin(ordinals, quarter_ordinals))
+    rank = np.zeros(len(rows), dtype=np.intp)
+    for position, ordinal in enumerate(quarter_ordinals):
+        rank[ordinals[rows] == ordinal] = position
+    order = rows[np.lexsort((prices['Verkaufspreis'][rows], rank))]
+    ends = np.cumsum(np.bincount(rank, minlength=len(quarters)))
+    current = order[:ends[0]]
+    current = current[~np.isnan(prices['Wunschpreis'][current])]
+    wunschpreis_order = current[np.argsort(prices['Wunschpreis'][current], kind='stable')]
+    return {
+        'Verkaufspreis': {
+            'values': prices['Verkaufspreis'][order],
+            'filter_index': build_filter_index(data.take(order)),
+            'starts': np.concatenate([[0], ends[:-1]]),
+            'ends': ends,
+        },
+        'Wunschpreis': {
+            'values': prices['Wunschpreis'][wunschpreis_order],
+            'filter_index': build_filter_index(data.take(wunschpreis_order)),
+            'starts': np.array([0]),
+            'ends': np.array([len(wunschpreis_order)]),
+        },
+    }
+
+
+def batch_tile_kpis(window, selections):
+    # Tile values (KPI_COLUMNS) of many selections ({column: value} as in the dropdowns), the
+    # same as tile_kpis() gives for each, from a tile_window(). The rows a selection picks from
+    # the window keep its order, so all its medians are read off by position: no sorting or
+    # grouping per selection. Columns with one entry per selection.
+    counts = {}
+    medians = {}
+    for measure in MEASURES:
+        part = window[measure]
+        n_rows = len(part['values'])
+        counts[measure] = np.zeros((len(selections), len(part['starts'])), dtype=np.int64)
+        medians[measure] = np.full((len(selections), len(part['starts'])), np.nan)
+        for position, filters in enumerate(selections):
+            mask = select_mask(part['filter_index'], filters, n_rows)
+            selected = np.arange(n_rows) if mask is None else np.flatnonzero(mask)
+            counts[measure][position], medians[measure][position] = block_medians(
+                part['values'], selected, part['starts'], part['ends'])
+
+    median_price = np.round(medians['Verkaufspreis'][:, 0])
+    columns = {
+        'diff_previous_year': percentage_diffs(median_price, medians['Verkaufspreis'][:, 1]),
+        'diff_previous_quarter': percentage_diffs(median_price, medians['Verkaufspreis'][:, 2]),
+        'diff_wunschpreis': percentage_diffs(median_price, medians['Wunschpreis'][:, 0]),
+    }
+    return {
+        'median_price': [None if np.isnan(value) else int(value) for value in median_price],
+        **{column: [None if np.isnan(value) else float(value) for value in values] for column, values in columns.items()},
+        'count': [int(count) for count in counts['Verkaufspreis'][:, 0]],
+    }
@@ -0,0 +1,30 @@
+import argparse
+import os
+
+from bundle import write_bundle
+from state import build_state
+
+
+def build(args):
+    state = build_state(args.export)
+    name = os.path.splitext(os.path.basename(args.export))[0]
+    output = args.output or f'{name}-{state.version}.bundle.json'
+    write_bundle(state, output)
+    print(output)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m priceanalyzer', description='Price Analyzer command line tools')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    build_parser = commands.add_parser('build', help='preprocess a price export into a ready-to-serve bundle')
+    build_parser.add_argument('export', help='price export (CSV), e.g. pricedata8.csv')
+    build_parser.add_argument('-o', '--output', help='bundle file (default: <export>-<version>.bundle.json)')
+    build_parser.set_defaults(handler=build)
+
+    args = parser.parse_args(argv)
+    args.handler(args)
+
+
+if __name__ == '__main__':
+    main()
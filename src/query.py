@@ -0,0 +1,168 @@
+import logging
+import os
+import threading
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+
+from cube import MEASURES, SKETCH_DIMENSIONS, TOTAL, cube_from_cells, cube_from_sketches, filter_sketches, sorted_cells
+from filters import EXTRA_FILTERS, segment_cube, select_rows
+from kpis import KPI_COLUMNS, batch_tile_kpis, tile_kpis, tile_window
+from windows import price_index_from_cells
+
+logger = logging.getLogger(__name__)
+
+# An extra-filter combination is materialised (a full cube of its rows) once it has been
+# requested this many times; at most MATERIALISED_MAX combinations are kept
+MATERIALISE_AFTER = int(os.environ.get('PRICEANALYZER_MATERIALISE_AFTER', '3'))
+MATERIALISED_MAX = int(os.environ.get('PRICEANALYZER_MATERIALISED_MAX', '64'))
+
+
+def filter_key(extra_filters):
+    # The set extra filters as a hashable key, () if none is set
+    return tuple((column, value) for column, value in zip(EXTRA_FILTERS, extra_filters) if value not in (None, TOTAL))
+
+
+class QueryPlanner:
+    # Answers a selection (segment plus extra filters) from the cheapest source available:
+    # 1. 'cube': no extra filter, the precomputed cube of the state
+    # 2. 'materialised': a cube with all roll-ups of the extra-filter combination, built
+    #    once the combination has been requested MATERIALISE_AFTER times
+    # 3. 'scan': only the selected segment, aggregated from the rows found by the filter index
+
+    # Extra filters the planner can apply
+    filters = EXTRA_FILTERS
+
+    def __init__(self, data, filter_index, cube, price_index):
+        self.data = data
+        self.filter_index = filter_index
+        self.cube = cube
+        self.price_index = price_index
+        self.frequency = Counter()
+        self.materialised = {}
+        self.tile_windows = {}
+        self.lock = threading.Lock()
+
+    def query(self, category, age_cat, extra_filters):
+        # (plan, cube, price_index) for the selection
+        key = filter_key(extra_filters)
+        if not key:
+            return 'cube', self.cube, self.price_index
+        with self.lock:
+            self.frequency[key] += 1
+            count = self.frequency[key]
+        if key in self.materialised:
+            return ('materialised',) + self.materialised[key]
+        if count >= MATERIALISE_AFTER:
+            return ('materialised',) + self.materialise(key)
+        rows = select_rows(self.filter_index, {'Kategorie': category, 'fahrzeugalter_cat': age_cat, **dict(key)}, len(self.data))
+        return ('scan',) + segment_cube(self.data, rows, category, age_cat)
+
+    def materialise(self, key):
+        rows = select_rows(self.filter_index, dict(key), len(self.data))
+        subset = self.data.take(rows)
+        cells = sorted_cells(subset)
+        rollups = cube_from_cells(cells), price_index_from_cells(cells)
+        with self.lock:
+            if key not in self.materialised and len(self.materialised) >= MATERIALISED_MAX:
+                # Make room by dropping the least requested combination
+                del self.materialised[min(self.materialised, key=self.frequency.__getitem__)]
+            self.materialised[key] = rollups
+        logger.info('Materialised %s (%d rows)', dict(key), len(subset))
+        return rollups
+
+    def quarter_prices(self, category, age_cat, extra_filters, quarter):
+        # Sorted prices ({measure: array}) of the selection in one quarter, None without sales.
+        # Read straight from the rows: the request is not counted and nothing is materialised,
+        # e.g. for a background job, whose process does not share the planner.
+        filters = {'Kategorie': category, 'fahrzeugalter_cat': age_cat, **dict(filter_key(extra_filters))}
+        rows = select_rows(self.filter_index, filters, len(self.data))
+        if rows is None:
+            rows = np.arange(len(self.data))
+        rows = rows[self.data['Quarter'].array.asi8[rows] == pd.Period(quarter, freq='Q').ordinal]
+        if not len(rows):
+            return None
+        return {measure: np.sort(self.data[measure].to_numpy()[rows]) for measure in MEASURES}
+
+    def tile_window(self, current_quarter):
+        # Presorted rows for batch KPI queries (see kpis.tile_window), built on first use
+        window = self.tile_windows.get(current_quarter)
+        if window is None:
+            window = tile_window(self.data, current_quarter)
+            with self.lock:
+                self.tile_windows = {current_quarter: window}
+        return window
+
+    def batch_kpis(self, current_quarter, selections):
+        # KPI_COLUMNS of many selections ({column: value} over FILTER_DIMENSIONS), see api.py
+        return batch_tile_kpis(self.tile_window(current_quarter), selections)
+
+    def inherit(self, other):
+        # Carry the request counts over from the planner of the previous state and
+        # materialise its hot combinations right away
+        self.frequency.update(other.frequency)
+        for key in other.materialised:
+            self.materialise(key)
+
+
+class SketchPlanner:
+    # Answers selections in streaming mode, where only the sketch tables are kept (see
+    # cube.fold_chunk): an extra-filter combination is answered with a cube of all segments
+    # from the sketches of its cells, merged. The cubes of the requested combinations are kept
+    # (at most MATERIALISED_MAX). Medians are approximate like those of the streamed cube.
+
+    # Extra filters the planner can apply
+    filters = [column for column in EXTRA_FILTERS if column in SKETCH_DIMENSIONS]
+
+    def __init__(self, sketches, cube):
+        self.sketches = sketches
+        self.cube = cube
+        self.frequency = Counter()
+        self.materialised = {}
+        self.lock = threading.Lock()
+
+    def query(self, category, age_cat, extra_filters):
+        # (plan, cube, price_index) for the selection; there is no price index without the rows
+        key = filter_key(extra_filters)
+        if not key:
+            return 'cube', self.cube, None
+        with self.lock:
+            self.frequency[key] += 1
+        cube = self.materialised.get(key)
+        if cube is None:
+            cube = self.materialise(key)
+        return 'sketch', cube, None
+
+    def filtered_cube(self, key):
+        # Cube of the rows matching the extra filters, from the merged sketches of their cells
+        cube = self.materialised.get(key)
+        return cube if cube is not None else cube_from_sketches(filter_sketches(self.sketches, dict(key)))
+
+    def materialise(self, key):
+        cube = self.filtered_cube(key)
+        with self.lock:
+            if key not in self.materialised and len(self.materialised) >= MATERIALISED_MAX:
+                del self.materialised[min(self.materialised, key=self.frequency.__getitem__)]
+            self.materialised[key] = cube
+        return cube
+
+    def batch_kpis(self, current_quarter, selections):
+        # KPI_COLUMNS of many selections, one merge of the sketches per filter combination
+        # (without keeping the cubes, a batch would push out the combinations of the dashboard)
+        cubes = {}
+        result = {column: [] for column in KPI_COLUMNS}
+        for selection in selections:
+            key = filter_key([selection[column] for column in EXTRA_FILTERS])
+            if key not in cubes:
+                cubes[key] = self.filtered_cube(key) if key else self.cube
+            kpis = tile_kpis(cubes[key], selection['Kategorie'], selection['fahrzeugalter_cat'], current_quarter)
+            for column in KPI_COLUMNS:
+                result[column].append(kpis[column])
+        return result
+
+    def inherit(self, other):
+        # See QueryPlanner.inherit
+        self.frequency.update(other.frequency)
+        for key in other.materialised:
+            self.materialise(key)
@@ -0,0 +1,307 @@
+import glob
+import hashlib
+import logging
+import os
+import threading
+import time
+from dataclasses import dataclass, replace
+
+from bundle import read_bundle
+from cube import build_sketches, cube_from_cells, cube_from_sketches, segment_order, sorted_cells, update_cube
+from dataload import append_delta, file_hash, load_data, read_csv
+from figures import all_price_graphs, build_static_figures
+from filters import FILTER_DIMENSIONS, build_filter_index, extend_filter_index
+from kpis import all_tile_kpis, kpi_table
+from query import QueryPlanner, SketchPlanner
+from windows import latest_complete_quarter, price_index_from_cells, update_price_index
+
+logger = logging.getLogger(__name__)
+
+# Directory holding the price exports and the export served by default
+DATA_DIR = os.environ.get('PRICEDATA_DIR', '.')
+DATA_FILE = os.environ.get('PRICEDATA_FILE', 'pricedata8.csv')
+
+# With PRICEDATA_WATCH=1 the directory is polled for new exports every PRICEDATA_WATCH_INTERVAL
+# seconds, and an export in DATA_DIR that is strictly newer (by modification time) than
+# PRICEDATA_FILE is served instead of it
+WATCH = os.environ.get('PRICEDATA_WATCH', '0') == '1'
+WATCH_INTERVAL = float(os.environ.get('PRICEDATA_WATCH_INTERVAL', '30'))
+WATCH_PATTERN = 'pricedata*.csv'
+
+# Delta exports with new sales only. They are appended to the base export they are not older
+# than, and only the quarters they contain are re-aggregated.
+DELTA_PATTERN = 'pricedelta*.csv'
+
+# With PRICEDATA_STREAMING=1 the exports are read in chunks of PRICEDATA_CHUNK_SIZE rows that
+# are folded into quantile sketches one by one. Peak memory no longer grows with the export, but
+# the rows are not kept (state.data is None), the medians are approximate and only the extra
+# filters in cube.SKETCH_DIMENSIONS are available.
+STREAMING = os.environ.get('PRICEDATA_STREAMING', '0') == '1'
+CHUNK_SIZE = int(os.environ.get('PRICEDATA_CHUNK_SIZE', '100000'))
+
+# With PRICEANALYZER_BUNDLE set to a bundle written by `python -m priceanalyzer build`, the
+# state is read from the bundle and no export is parsed or aggregated in the web process
+BUNDLE = os.environ.get('PRICEANALYZER_BUNDLE')
+
+# Set by gunicorn.conf.py to the pid of the master when it preloads the app. The master never
+# serves a request, so it starts no watcher; the workers start their own after the fork.
+MASTER_PID = os.environ.get('PRICEANALYZER_MASTER_PID')
+
+# With PRICEANALYZER_LAZY=1 the app does not build the state while being imported. A warm-up
+# thread builds it instead, so the server can accept connections right away.
+LAZY = os.environ.get('PRICEANALYZER_LAZY', '0') == '1'
+
+
+@dataclass(frozen=True)
+class DashboardState:
+    # Everything derived from one price export. A new export produces a new state object,
+    # which replaces the old one in a single assignment.
+    version: str
+    source: str
+    deltas: tuple
+    data: object
+    options: dict
+    current_quarter: str
+    cube: dict
+    price_index: dict
+    planner: object
+    kpis: dict
+    table: object
+    graphs: dict
+    figures: dict
+
+
+def export_path():
+    if BUNDLE:
+        return BUNDLE
+    default = os.path.join(DATA_DIR, DATA_FILE)
+    if WATCH:
+        # Older exports lying next to the default one often share its modification time (e.g.
+        # after a checkout), so only a strictly newer export replaces it
+        newest = max(glob.glob(os.path.join(DATA_DIR, WATCH_PATTERN)), key=os.path.getmtime, default=default)
+        if not os.path.exists(default) or os.path.getmtime(newest) > os.path.getmtime(default):
+            return newest
+    return default
+
+
+def delta_paths(path):
+    base_mtime = os.path.getmtime(path)
+    deltas = glob.glob(os.path.join(DATA_DIR, DELTA_PATTERN))
+    return sorted(delta for delta in deltas if os.path.getmtime(delta) >= base_mtime)
+
+
+def chained_version(version, digest):
+    # Version of a state after appending one delta export
+    return hashlib.sha256(f'{version}-{digest}'.encode()).hexdigest()[:16]
+
+
+def dropdown_options(data, options=None):
+    # Values of the filter dimensions in order of first appearance, merged into options if given
+    if options is None:
+        options = {column: [] for column in FILTER_DIMENSIONS}
+    for column, values in options.items():
+        for value in data[column].dropna().unique():
+            if str(value) not in values:
+                values.append(str(value))
+    return options
+
+
+def stream_chunks(paths, options, last_sales):
+    for path in paths:
+        for chunk in read_csv(path, chunksize=CHUNK_SIZE):
+            dropdown_options(chunk, options)
+            last_sales.append(chunk['Verkauf in'].max())
+            yield chunk
+
+
+def build_state(path):
+    if BUNDLE:
+        bundle = read_bundle(path)
+        return DashboardState(source=path, data=None, price_index=None, planner=None,
+                              table=kpi_table(bundle['cube']), **bundle)
+
+    deltas = delta_paths(path)
+    digests = [file_hash(source) for source in [path, *deltas]]
+    version = digests[0][:16]
+    for digest in digests[1:]:
+        version = chained_version(version, digest)
+
+    if STREAMING:
+        data = None
+        price_index = None
+        options = {column: [] for column in FILTER_DIMENSIONS}
+        last_sales = []
+        sketches = build_sketches(stream_chunks([path, *deltas], options, last_sales))
+        cube = cube_from_sketches(sketches)
+        planner = SketchPlanner(sketches, cube)
+        current_quarter = latest_complete_quarter(max(last_sales))
+    else:
+        data = load_data(path, digests[0])
+        for delta, digest in zip(deltas, digests[1:]):
+            data = append_delta(data, load_data(delta, digest))
+        options = dropdown_options(data)
+        # Cube and price index from the same sorted runs, one sort per measure
+        cells = sorted_cells(data)
+        cube = cube_from_cells(cells)
+        price_index = price_index_from_cells(cells)
+        planner = QueryPlanner(data, build_filter_index(data), cube, price_index)
+        current_quarter = latest_complete_quarter(data['Verkauf in'].max())
+
+    table = kpi_table(cube)
+    return DashboardState(
+        version=version,
+        source=path,
+        deltas=tuple(deltas),
+        data=data,
+        options=options,
+        current_quarter=current_quarter,
+        cube=cube,
+        price_index=price_index,
+        planner=planner,
+        kpis=all_tile_kpis(table, options, current_quarter),
+        table=table,
+        graphs=all_price_graphs(cube, options, current_quarter),
+        figures=build_static_figures(cube, current_quarter),
+    )
+
+
+def empty_state():
+    # Placeholder with all components but no data, e.g. for validating the layout
+    return DashboardState(
+        version='',
+        source='',
+        deltas=(),
+        data=None,
+        options={column: [] for column in FILTER_DIMENSIONS},
+        current_quarter=None,
+        cube={},
+        price_index=None,
+        planner=None,
+        kpis={},
+        table=kpi_table({}),
+        graphs={},
+        figures=build_static_figures({}, None),
+    )
+
+
+def apply_deltas(state, deltas):
+    # Incremental ingestion: parse only the new rows (each delta gets its own snapshot), extend
+    # the filter index and the dropdown options by them and recompute only the cube quarters
+    # they touch
+    data = state.data
+    filter_index = state.planner.filter_index
+    options = {column: list(values) for column, values in state.options.items()}
+    current_quarter = state.current_quarter
+    version = state.version
+    quarters = set()
+    for delta in deltas:
+        delta_digest = file_hash(delta)
+        rows = load_data(delta, delta_digest)
+        filter_index = extend_filter_index(filter_index, len(data), rows)
+        data = append_delta(data, rows)
+        dropdown_options(rows, options)
+        if rows['Verkauf in'].notna().any():
+            current_quarter = max(current_quarter, latest_complete_quarter(rows['Verkauf in'].max()))
+        quarters.update(rows['Quarter'].unique())
+        version = chained_version(version, delta_digest)
+    # Cube and price index of the touched quarters from the same sorted runs
+    cells = sorted_cells(data[data['Quarter'].isin(list(quarters))])
+    order = segment_order(data)
+    cube = update_cube(state.cube, cube_from_cells(cells), quarters, order)
+    price_index = update_price_index(state.price_index, price_index_from_cells(cells), quarters, order)
+    table = kpi_table(cube)
+    return replace(
+        state,
+        version=version,
+        deltas=state.deltas + tuple(deltas),
+        data=data,
+        options=options,
+        current_quarter=current_quarter,
+        cube=cube,
+        price_index=price_index,
+        planner=QueryPlanner(data, filter_index, cube, price_index),
+        kpis=all_tile_kpis(table, options, current_quarter),
+        table=table,
+        graphs=all_price_graphs(cube, options, current_quarter),
+        figures=build_static_figures(cube, current_quarter),
+    )
+
+
+_state = None
+_state_lock = threading.Lock()
+_watcher_pid = None
+
+
+def current_state():
+    # Callbacks fetch the state once and use only that object, so a swap in the middle of
+    # a request never mixes data of two exports
+    global _state
+    if _state is None:
+        with _state_lock:
+            if _state is None:
+                _state = build_state(export_path())
+    if WATCH:
+        ensure_watcher()
+    return _state
+
+
+def ready_state():
+    # The current state if it has been built, None while still warming up (never blocks)
+    return _state
+
+
+def start_warmup():
+    threading.Thread(target=current_state, name='pricedata-warmup', daemon=True).start()
+
+
+def ensure_watcher():
+    # Threads do not survive gunicorn's fork, so every worker process starts its own watcher
+    global _watcher_pid
+    if _watcher_pid == os.getpid() or str(os.getpid()) == MASTER_PID:
+        return
+    with _state_lock:
+        if _watcher_pid != os.getpid():
+            _watcher_pid = os.getpid()
+            threading.Thread(target=watch_exports, name='pricedata-watcher', daemon=True).start()
+
+
+def export_signature(path):
+    stat = os.stat(path)
+    return path, stat.st_mtime_ns, stat.st_size
+
+
+def carry_over_queries(old_state, new_state):
+    # Keep the frequent filter combinations materialised across reloads
+    if old_state.planner is not None and new_state.planner is not None:
+        new_state.planner.inherit(old_state.planner)
+
+
+def watch_exports():
+    # Exports should be moved into DATA_DIR in one step (write elsewhere, then rename);
+    # a half-written file is picked up again once its size or modification time changes
+    global _state
+    signature = export_signature(_state.source)
+    while True:
+        time.sleep(WATCH_INTERVAL)
+        try:
+            path = export_path()
+            new_signature = export_signature(path)
+            if new_signature != signature:
+                signature = new_signature
+                new_state = build_state(path)
+                carry_over_queries(_state, new_state)
+                _state = new_state
+                logger.info('Switched to %s (version %s)', path, new_state.version)
+                continue
+            if BUNDLE:
+                continue
+            new_deltas = [delta for delta in delta_paths(path) if delta not in _state.deltas]
+            if new_deltas:
+                # Without the rows (streaming mode) the cube cannot be patched, so re-stream everything
+                new_state = apply_deltas(_state, new_deltas) if _state.data is not None else build_state(path)
+                carry_over_queries(_state, new_state)
+                _state = new_state
+                logger.info('Appended %s (version %s)', ', '.join(new_deltas), new_state.version)
+        except Exception:
+            # Keep serving the current state if an export is incomplete or malformed
+            logger.exception('Reloading the price data failed')
@@ -0,0 +1,90 @@
+import numpy as np
+import pandas as pd
+
+from cube import lookup
+
+# Offsets (in quarters) of the comparison windows
+QOQ = 1
+YOY = 4
+
+# Number of quarters shown in the charts
+CHART_QUARTERS = 5
+
+
+def quarter_label(quarter):
+    return pd.Period(quarter, freq='Q').strftime('Q%q/%Y')
+
+
+def latest_complete_quarter(last_sale_date):
+    # A quarter counts as complete once the export has sales from its last month
+    quarter = pd.Period(last_sale_date, freq='Q')
+    if pd.Timestamp(last_sale_date).month != quarter.end_time.month:
+        quarter -= 1
+    return str(quarter)
+
+
+def window_quarters(current_quarter, length=1, offset=0):
+    # The `length` quarters ending `offset` quarters before the current quarter, oldest first:
+    # offset QOQ compares with the previous quarter, YOY with the previous year, and
+    # length=4 gives a trailing year
+    end = pd.Period(current_quarter, freq='Q') - offset
+    return [str(end - i) for i in reversed(range(length))]
+
+
+def price_index_from_cells(cells):
+    # Sorted Verkaufspreis and Wunschpreis arrays per cube segment and quarter, so medians
+    # and percentiles of any window come from the index instead of rescanning the data.
+    # The arrays are the runs of cube.sorted_cells(), views of one array per roll-up level.
+    index = {}
+    for segment, quarter, _, _, _, runs in cells:
+        index.setdefault(segment, {})[quarter] = runs
+    return index
+
+
+def update_price_index(price_index, partial, quarters, order):
+    # Replace the given quarters by those of partial, the index of their rows, and return a new
+    # index with the segments sorted with order (see cube.update_cube)
+    quarters = set(str(quarter) for quarter in quarters)
+    updated = {}
+    for segment in sorted(price_index.keys() | partial.keys(), key=order):
+        merged = {quarter: arrays for quarter, arrays in price_index.get(segment, {}).items() if quarter not in quarters}
+        merged.update(partial.get(segment, {}))
+        if merged:
+            updated[segment] = dict(sorted(merged.items()))
+    return updated
+
+
+def sorted_quantile(values, q):
+    # Quantile of an already sorted array in O(1), interpolating like np.quantile
+    position = q * (len(values) - 1)
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return float(values[lower] + (values[upper] - values[lower]) * (position - lower))
+
+
+def window_values(price_index, category, age_cat, quarters, measure):
+    # Sorted prices of a segment over several quarters (merging the presorted quarter arrays)
+    segment = price_index.get((category, age_cat), {})
+    arrays = [segment[quarter][measure] for quarter in quarters if quarter in segment]
+    if not arrays:
+        return None
+    return arrays[0] if len(arrays) == 1 else np.sort(np.concatenate(arrays), kind='mergesort')
+
+
+def window_stats(cube, price_index, category, age_cat, quarters):
+    # Median Verkaufspreis, median Wunschpreis and count of a segment over a window of
+    # quarters; single quarters come straight from the cube. None without sales (or without
+    # an index for multi-quarter windows, e.g. in streaming or bundle mode).
+    if len(quarters) == 1:
+        return lookup(cube, category, age_cat, quarters[0])
+    if price_index is None:
+        return None
+    prices = window_values(price_index, category, age_cat, quarters, 'Verkaufspreis')
+    if prices is None:
+        return None
+    wunschpreise = window_values(price_index, category, age_cat, quarters, 'Wunschpreis')
+    return {
+        'Verkaufspreis': sorted_quantile(prices, 0.5),
+        'Wunschpreis': sorted_quantile(wunschpreise, 0.5),
+        'count': len(prices),
+    }